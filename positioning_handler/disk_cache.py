@@ -0,0 +1,100 @@
+"""
+Storage shared by the on-disk caches of the project: the parsed pozyx logs, the intermediate results of feature
+extraction and the transcriptions of the speech to text check.
+A cache is a folder with one entry per key, an entry being a file or a folder. The modification time of an entry
+records its last use, and when the folder grows beyond its size budget the entries unused for the longest time
+are removed first.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+# written entries are built under this suffix first and renamed once complete
+_TEMP_MARK = ".tmp-"
+
+
+def get_cache_key(*part_list):
+    """the key of an entry, from the bytes of each of its inputs"""
+    a_hash = hashlib.blake2b(digest_size=16)
+    for a_part in part_list:
+        # the length keeps the parts apart
+        a_hash.update(len(a_part).to_bytes(8, "little"))
+        a_hash.update(a_part)
+    return a_hash.hexdigest()
+
+
+def touch_entry(entry_path: str):
+    """record the use of an entry"""
+    try:
+        os.utime(entry_path)
+    except FileNotFoundError:
+        # removed by another run in the meantime, it is only missed next time
+        pass
+
+
+def write_entry(entry_path: str, write_function):
+    """
+    create an entry without ever exposing a half-written one to the readers
+    :param entry_path: path of the entry in the cache folder
+    :param write_function: called with a temporary path, it writes the file or the folder of the entry there
+    """
+    os.makedirs(os.path.dirname(entry_path) or ".", exist_ok=True)
+    temp_path = "{}{}{}".format(entry_path, _TEMP_MARK, os.getpid())
+    write_function(temp_path)
+    try:
+        os.rename(temp_path, entry_path)
+    except OSError:
+        # a folder with the same key has been created by another run in the meantime
+        _remove_path(temp_path)
+
+
+def evict_entries(cache_dir: str, max_cache_bytes: int, keep=(), cache_name: str = "cache"):
+    """
+    remove the least recently used entries of cache_dir until it fits max_cache_bytes
+    :param keep: names of the entries that are never removed, like the one just written
+    :param cache_name: used in the log
+    """
+    entry_list = []
+    for a_name in os.listdir(cache_dir):
+        if _TEMP_MARK in a_name:
+            continue
+        a_path = os.path.join(cache_dir, a_name)
+        try:
+            entry_list.append((os.path.getmtime(a_path), a_name, _get_size(a_path)))
+        except FileNotFoundError:
+            pass
+
+    total_size = sum(an_entry[2] for an_entry in entry_list)
+    removed_count = 0
+    for last_used, a_name, size in sorted(entry_list):
+        if total_size <= max_cache_bytes:
+            break
+        if a_name in keep:
+            continue
+        _remove_path(os.path.join(cache_dir, a_name))
+        total_size -= size
+        removed_count += 1
+    if removed_count != 0:
+        logging.info("removed {} entries from the {}".format(removed_count, cache_name))
+
+
+###################################################################
+# code below may not be useful if you only want to apply the code #
+###################################################################
+
+def _get_size(a_path: str):
+    if not os.path.isdir(a_path):
+        return os.path.getsize(a_path)
+    return sum(os.path.getsize(os.path.join(a_path, a_file)) for a_file in os.listdir(a_path))
+
+
+def _remove_path(a_path: str):
+    if os.path.isdir(a_path):
+        shutil.rmtree(a_path, ignore_errors=True)
+    else:
+        try:
+            os.remove(a_path)
+        except FileNotFoundError:
+            pass
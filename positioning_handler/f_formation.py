@@ -1,8 +1,11 @@
+import logging
 import math
 
 import numpy as np
 import pandas as pd
 
+from positioning_handler.formation_store import write_formation_store
+
 
 def extract_formation(pozyx_dict: dict, id_list: list, device_id, output_path: str, session_name: str,
                       fov_thres: int, distance_thres: int, do_correction: bool):
@@ -22,43 +25,291 @@ def extract_formation(pozyx_dict: dict, id_list: list, device_id, output_path: s
     :return:
     """
 
-    result_dict = {
-        "session_name": [session_name for _ in pozyx_dict[device_id]["timestamp"]],
-        "timestamp": list(pozyx_dict[device_id]["timestamp"]),
+    timestamps, present, formation = compute_formation(pozyx_dict, id_list, fov_thres, distance_thres, do_correction)
+    result_df = _get_formation_dataframe(pozyx_dict, id_list, device_id, session_name, timestamps, formation)
+    result_df.to_csv(output_path)
+
+
+def extract_session_formation(pozyx_dict: dict, id_list: list, output_paths: list, session_name: str,
+                              fov_thres: int, distance_thres: int, do_correction: bool, spatial_index: bool = False,
+                              store_path: str = None):
+    """
+    The session level version of extract_formation.
+    The formation of the whole session is computed once, then the output file of every device is written from it.
+
+    :param pozyx_dict: the dict containing all the Dataframe of interploated pozyx data
+    :param id_list: list of all the id appeared in the pozyx_dict
+    :param output_paths: paths for output, aligned with id_list, None for not writing the csv files
+    :param session_name: session name
+    :param fov_thres: threshold of fov (field-of-view)
+    :param distance_thres: threshold of distance between different positions
+    :param do_correction: do correction or not
+    :param spatial_index: only test the pairs close enough to each other, for rooms with many devices
+    :param store_path: folder for saving the result in the compact format of formation_store, if given
+    :return:
+    """
+    pruning_stats = {} if spatial_index else None
+    timestamps, present, formation = compute_formation(pozyx_dict, id_list, fov_thres, distance_thres, do_correction,
+                                                       spatial_index=spatial_index, pruning_stats=pruning_stats)
+    if spatial_index:
+        logging.info("spatial index kept {} of {} pair-timestamps ({:.1%} pruned), {} in formation".format(
+            pruning_stats["candidates"], pruning_stats["pair_timestamps"], pruning_stats["pruned_ratio"],
+            pruning_stats["in_formation"]))
+
+    if store_path is not None:
+        write_formation_store(store_path, id_list, timestamps, present, formation, session_name)
+    if output_paths is not None:
+        for device_id, output_path in zip(id_list, output_paths):
+            result_df = _get_formation_dataframe(pozyx_dict, id_list, device_id, session_name, timestamps, formation)
+            result_df.to_csv(output_path)
+
+
+def sweep_formation(pozyx_dict: dict, id_list: list, fov_list: list, distance_list: list,
+                    correction_list: list = (False, True)):
+    """
+    Compute the f-formation for a grid of thresholds, for tuning fov_thres, distance_thres and do_correction.
+    The distances and the angles of every pair at every timestamp are computed once (the angles once per
+    correction setting), then each combination of thresholds is only a comparison against them.
+
+    :param pozyx_dict: the dict containing all the Dataframe of interploated pozyx data
+    :param id_list: list of all the id appeared in the pozyx_dict
+    :param fov_list: thresholds of fov to evaluate
+    :param distance_list: thresholds of distance to evaluate
+    :param correction_list: correction settings to evaluate
+    :return: a dict with "timestamps" (T,), "pairs" (P, 2) holding the ids of each unordered pair, "correction",
+     "fov", "distance" holding the evaluated thresholds, and "formation", a bool array of shape
+     (len(correction_list), len(fov_list), len(distance_list), P, T) packed with np.packbits along the time axis
+    """
+    timestamps, present, x, y, yaw = _align_devices(pozyx_dict, id_list)
+    first, second = np.triu_indices(len(id_list), k=1)
+
+    p1_to_p2_x, p1_to_p2_y, distance = _get_pair_distance(x[first], y[first], x[second], y[second])
+    distance_masks = [distance <= distance_thres for distance_thres in distance_list]
+
+    packed_shape = (len(correction_list), len(fov_list), len(distance_list), len(first), (len(timestamps) + 7) // 8)
+    formation = np.zeros(packed_shape, dtype=np.uint8)
+    for i, do_correction in enumerate(correction_list):
+        angle_p1_to_p2, angle_p2_to_p1 = _get_pair_angles(p1_to_p2_x, p1_to_p2_y, distance, yaw[first], yaw[second],
+                                                          bool(do_correction))
+        for j, fov in enumerate(fov_list):
+            angle_mask = (angle_p1_to_p2 < fov / 2) & (angle_p2_to_p1 < fov / 2)
+            for k, distance_mask in enumerate(distance_masks):
+                formation[i, j, k] = np.packbits(angle_mask & distance_mask, axis=-1)
+
+    id_array = np.array(id_list)
+    return {
+        "timestamps": timestamps,
+        "pairs": np.stack([id_array[first], id_array[second]], axis=1),
+        "correction": np.array(correction_list, dtype=bool),
+        "fov": np.array(fov_list),
+        "distance": np.array(distance_list),
+        "formation": formation,
     }
-    for an_id in id_list:
-        if an_id == device_id:
-            result_dict[an_id] = [-1 for _ in pozyx_dict[device_id]["timestamp"]]
-        else:
-            result_dict[an_id] = [0 for _ in pozyx_dict[device_id]["timestamp"]]
-    current_device_df = pozyx_dict[device_id]
-    result_df = pd.DataFrame(result_dict)
-
-    for a_id in id_list:
-        if a_id != device_id:
-            for i, line in current_device_df.iterrows():
-                timestamp = current_device_df.iloc[i]["timestamp"]
-                if timestamp in pozyx_dict[a_id]["timestamp"].values:
-                    iterring_df = pozyx_dict[a_id]
-                    line = iterring_df.loc[iterring_df["timestamp"] == timestamp].iloc[0]
-
-                    iter_device_pos = np.array([line["x"], line["y"]])
-                    param_device_pos = np.array([current_device_df.iloc[i]["x"], current_device_df.iloc[i]["y"]])
-                    if _get_within_view(param_device_pos, float(current_device_df.iloc[i]["yaw"]), iter_device_pos,
-                                        float(line["yaw"]), fov_thres, distance_thres, do_correction):
-                        result_df.loc[i, a_id] = 1
 
-    result_df.to_csv(output_path)
+
+def summarize_sweep(sweep: dict):
+    """
+    count the seconds in formation of each pair for each combination of thresholds
+    :param sweep: the result of sweep_formation
+    :return: a DataFrame indexed by (correction, fov_threshold, distance_threshold), with a column for each pair
+    """
+    counts = np.unpackbits(sweep["formation"], axis=-1, count=len(sweep["timestamps"])).sum(axis=-1)
+    index = pd.MultiIndex.from_product([sweep["correction"], sweep["fov"], sweep["distance"]],
+                                       names=["correction", "fov_threshold", "distance_threshold"])
+    columns = ["{}-{}".format(a_pair[0], a_pair[1]) for a_pair in sweep["pairs"]]
+    return pd.DataFrame(counts.reshape(len(index), len(columns)), index=index, columns=columns)
+
+
+def compute_formation(pozyx_dict: dict, id_list: list, fov_thres: int, distance_thres: int, do_correction: bool,
+                      spatial_index: bool = False, pruning_stats: dict = None):
+    """
+    Compute the f-formation of every pair of devices at every timestamp with numpy array operations.
+    All the devices are aligned on the union of their timestamps first, a pair can only be in formation at the
+    timestamps where both devices have data.
+    Both persons of a pair must face each other, so the test is symmetric and it runs once for each unordered pair.
+
+    With spatial_index, the positions of every timestamp are put in a uniform grid with cells of distance_thres,
+    and the view test only runs on the pairs in the same or neighbouring cells. The result is the same, but the cost
+    follows the number of close pairs instead of the number of all pairs.
+
+    :param pozyx_dict: the dict containing all the Dataframe of interploated pozyx data
+    :param id_list: list of all the id appeared in the pozyx_dict
+    :param fov_thres: threshold of fov (field-of-view)
+    :param distance_thres: threshold of distance between different positions
+    :param do_correction: do correction or not
+    :param spatial_index: only test the pairs close enough to each other
+    :param pruning_stats: a dict filled with the counts of the pruning if given, only used with spatial_index
+    :return: (timestamps with shape (T,), bool array of shape (N, T) telling if a device has data at a timestamp,
+     bool array of shape (N, N, T) telling if two devices are in formation at a timestamp)
+    """
+    timestamps, present, x, y, yaw = _align_devices(pozyx_dict, id_list)
+
+    formation = np.zeros((len(id_list), len(id_list), len(timestamps)), dtype=bool)
+
+    if spatial_index:
+        first, second, time_index = _get_candidate_pairs(x, y, present, distance_thres)
+        in_formation = _get_within_view_array(x[first, time_index], y[first, time_index], yaw[first, time_index],
+                                              x[second, time_index], y[second, time_index], yaw[second, time_index],
+                                              fov_thres, distance_thres, do_correction)
+        formation[first[in_formation], second[in_formation], time_index[in_formation]] = True
+        formation[second[in_formation], first[in_formation], time_index[in_formation]] = True
+
+        if pruning_stats is not None:
+            present_count = present.sum(axis=0)
+            pair_timestamps = int((present_count * (present_count - 1) // 2).sum())
+            pruning_stats["pair_timestamps"] = pair_timestamps
+            pruning_stats["candidates"] = len(first)
+            pruning_stats["in_formation"] = int(in_formation.sum())
+            pruning_stats["pruned_ratio"] = 1 - len(first) / pair_timestamps if pair_timestamps else 0.0
+        return timestamps, present, formation
+
+    first, second = np.triu_indices(len(id_list), k=1)
+    pair_formation = _get_within_view_array(x[first], y[first], yaw[first], x[second], y[second], yaw[second],
+                                            fov_thres, distance_thres, do_correction)
+    pair_formation &= present[first] & present[second]
+
+    formation[first, second] = pair_formation
+    formation[second, first] = pair_formation
+    return timestamps, present, formation
 
 
 ###################################################################
 # code below may not be useful if you only want to apply the code #
 ###################################################################
 
-def _correction(radian: float):
+def _correction(radian):
     return 2 * math.pi - radian
 
 
+def _align_devices(pozyx_dict: dict, id_list: list):
+    """
+    put all the devices on the union of their timestamps
+    :return: (timestamps (T,), present (N, T), x (N, T), y (N, T), yaw (N, T)), the positions are nan where absent
+    """
+    timestamps = np.unique(np.concatenate([np.asarray(pozyx_dict[an_id]["timestamp"]) for an_id in id_list]))
+    present = np.zeros((len(id_list), len(timestamps)), dtype=bool)
+    x = np.full((len(id_list), len(timestamps)), np.nan)
+    y = np.full((len(id_list), len(timestamps)), np.nan)
+    yaw = np.full((len(id_list), len(timestamps)), np.nan)
+
+    for i, an_id in enumerate(id_list):
+        a_df = pozyx_dict[an_id]
+        position = np.searchsorted(timestamps, np.asarray(a_df["timestamp"]))
+        present[i, position] = True
+        x[i, position] = np.asarray(a_df["x"], dtype=float)
+        y[i, position] = np.asarray(a_df["y"], dtype=float)
+        yaw[i, position] = np.asarray(a_df["yaw"], dtype=float)
+    return timestamps, present, x, y, yaw
+
+
+def _get_candidate_pairs(x: np.ndarray, y: np.ndarray, present: np.ndarray, distance_thres: int):
+    """
+    find the pairs of devices in the same or neighbouring grid cells at each timestamp.
+    Two devices within distance_thres of each other are always in neighbouring cells, so no pair in formation is lost.
+    :return: (first device index, second device index, timestamp index), with first < second within a cell
+    """
+    if distance_thres <= 0:
+        # only devices at the same position are that close, and they cannot face each other
+        empty = np.array([], dtype=int)
+        return empty, empty, empty
+
+    device_index, time_index = np.nonzero(present)
+    # slightly larger cells, so the rounding of the division never moves two close devices two cells apart
+    cell_size = distance_thres * (1 + 1e-9)
+    cell_x = np.floor(x[device_index, time_index] / cell_size).astype(np.int64)
+    cell_y = np.floor(y[device_index, time_index] / cell_size).astype(np.int64)
+    cell_x -= cell_x.min() - 1 if len(cell_x) else 0
+    cell_y -= cell_y.min() - 1 if len(cell_y) else 0
+    # one key per (timestamp, cell), with an empty border of cells so the neighbours never wrap around
+    width = int(cell_y.max()) + 2 if len(cell_y) else 1
+    height = int(cell_x.max()) + 2 if len(cell_x) else 1
+    keys = (time_index.astype(np.int64) * height + cell_x) * width + cell_y
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    first_list, second_list, time_list = [], [], []
+    # half of the neighbourhood, the other half is found from the other side of each pair
+    for offset_x, offset_y in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        neighbour_keys = keys + offset_x * width + offset_y
+        lower = np.searchsorted(sorted_keys, neighbour_keys, side="left")
+        upper = np.searchsorted(sorted_keys, neighbour_keys, side="right")
+        counts = upper - lower
+        point = np.repeat(np.arange(len(keys)), counts)
+        # position of each match inside the sorted keys
+        match = order[np.repeat(lower - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        if offset_x == 0 and offset_y == 0:
+            # pairs inside the same cell are found twice and with themselves
+            keep = device_index[point] < device_index[match]
+            point = point[keep]
+            match = match[keep]
+        first_list.append(device_index[point])
+        second_list.append(device_index[match])
+        time_list.append(time_index[point])
+
+    first = np.concatenate(first_list)
+    second = np.concatenate(second_list)
+    return np.minimum(first, second), np.maximum(first, second), np.concatenate(time_list)
+
+
+def _get_formation_dataframe(pozyx_dict: dict, id_list: list, device_id, session_name: str, timestamps: np.ndarray,
+                             formation: np.ndarray):
+    """the output format of a device, with a row for each timestamp of the device and a column for each device"""
+    device_timestamps = np.asarray(pozyx_dict[device_id]["timestamp"])
+    position = np.searchsorted(timestamps, device_timestamps)
+    device_index = id_list.index(device_id)
+
+    result_dict = {
+        "session_name": [session_name for _ in device_timestamps],
+        "timestamp": list(device_timestamps),
+    }
+    for i, an_id in enumerate(id_list):
+        if an_id == device_id:
+            result_dict[an_id] = [-1 for _ in device_timestamps]
+        else:
+            result_dict[an_id] = formation[device_index, i, position].astype(int)
+    return pd.DataFrame(result_dict)
+
+
+def _get_within_view_array(p1_x, p1_y, p1_yaw, p2_x, p2_y, p2_yaw, fov: int, distance_thres: int,
+                           do_correction: bool):
+    """the same test as _get_within_view, on numpy arrays of positions and yaws that broadcast together"""
+    p1_to_p2_x, p1_to_p2_y, distance = _get_pair_distance(p1_x, p1_y, p2_x, p2_y)
+    angle_p1_to_p2, angle_p2_to_p1 = _get_pair_angles(p1_to_p2_x, p1_to_p2_y, distance, p1_yaw, p2_yaw,
+                                                      do_correction)
+
+    # nan (same position, or absent device) compares as False, the same as in _get_within_view
+    return (distance <= distance_thres) & (angle_p1_to_p2 < fov / 2) & (angle_p2_to_p1 < fov / 2)
+
+
+def _get_pair_distance(p1_x, p1_y, p2_x, p2_y):
+    """the vector from p1 to p2 and its length"""
+    p1_to_p2_x = p2_x - p1_x
+    p1_to_p2_y = p2_y - p1_y
+    return p1_to_p2_x, p1_to_p2_y, np.sqrt(p1_to_p2_x * p1_to_p2_x + p1_to_p2_y * p1_to_p2_y)
+
+
+def _get_pair_angles(p1_to_p2_x, p1_to_p2_y, distance, p1_yaw, p2_yaw, do_correction: bool):
+    """angles in degrees between where each person faces and the direction to the other person"""
+    if do_correction:
+        p1_yaw = _correction(p1_yaw)
+        p2_yaw = _correction(p2_yaw)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        angle_p1_to_p2 = _get_angle_to(p1_to_p2_x, p1_to_p2_y, distance, p1_yaw)
+        angle_p2_to_p1 = _get_angle_to(-p1_to_p2_x, -p1_to_p2_y, distance, p2_yaw)
+    return angle_p1_to_p2, angle_p2_to_p1
+
+
+def _get_angle_to(to_x, to_y, distance, yaw):
+    """angle in degrees between the direction of yaw and the vector (to_x, to_y) of length distance"""
+    yaw_x = np.cos(yaw)
+    yaw_y = np.sin(yaw)
+    yaw_norm = np.sqrt(yaw_x * yaw_x + yaw_y * yaw_y)
+    dot_product = (to_x / distance) * (yaw_x / yaw_norm) + (to_y / distance) * (yaw_y / yaw_norm)
+    return np.degrees(np.arccos(dot_product))
+
+
 def _get_within_view(p1: np.ndarray, p1_yaw: float, p2: np.ndarray, p2_yaw: float, fov: int,
                      distance_thres: int, do_correction: bool):
     distance = np.linalg.norm(p1 - p2)
@@ -0,0 +1,190 @@
+"""
+Feature extraction of many sessions at once.
+The sessions of a manifest are spread over a pool of processes, and the features of all the sessions are gathered
+in one table. A session that fails is reported and does not stop the others. When a worker process dies, the
+pool is lost with every session not finished yet, so these sessions are run again, each one in its own process,
+and only the one that crashes again is reported as failed.
+"""
+
+import logging
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from positioning_handler.feature_extraction import feature_extraction
+from positioning_handler.feature_extraction import feature_extraction_windows
+from positioning_handler.formation_store import FormationStore
+
+
+def batch_feature_extraction(session_list: list, output_path: str = None, report_path: str = None,
+                             process_number: int = None, default_dict: dict = None):
+    """
+    :param session_list: list of dicts, each with the items of a feature_extraction mission (pozyx_device_id,
+     audio_data_path, formation_path or formation_store, audio_start_timestamp, session_name, windows, ...).
+     output_path is optional in a session, when given the csv of the session is written as well
+    :param output_path: path of the csv with the features of all the sessions
+    :param report_path: path of the csv with the status, the run time and the error of each session
+    :param process_number: number of worker processes, the number of cpus by default
+    :param default_dict: items used by every session that does not have them, like feature or connected_threshold
+    :return: the table of features, with a session_index column giving the position of the session in
+     session_list, and the report
+    """
+    if default_dict is None:
+        default_dict = {}
+    result_list = [None for _ in session_list]
+
+    merged_list = [dict(default_dict, **a_session) for a_session in session_list]
+
+    unfinished_list = []
+    with ProcessPoolExecutor(max_workers=process_number) as executor:
+        future_dict = {executor.submit(_run_session, a_session): i for i, a_session in enumerate(merged_list)}
+        for a_future in as_completed(future_dict):
+            i = future_dict[a_future]
+            try:
+                result_list[i] = a_future.result()
+            except BrokenProcessPool:
+                unfinished_list.append(i)
+                continue
+            except Exception:
+                result_list[i] = (None, 0.0, traceback.format_exc())
+            _log_session_result(i, merged_list[i], result_list[i])
+
+    if len(unfinished_list) != 0:
+        logging.warning("a worker process died, running the {} unfinished sessions again in their own processes"
+                        .format(len(unfinished_list)))
+        unfinished_list.sort()
+        with ThreadPoolExecutor(max_workers=process_number) as executor:
+            for i, a_result in zip(unfinished_list, executor.map(_run_session_isolated,
+                                                                 [merged_list[i] for i in unfinished_list])):
+                result_list[i] = a_result
+                _log_session_result(i, merged_list[i], a_result)
+
+    report_df = _get_report_dataframe(session_list, default_dict, result_list)
+    feature_df = _get_feature_table(result_list)
+    if output_path is not None:
+        feature_df.to_csv(output_path)
+    if report_path is not None:
+        report_df.to_csv(report_path)
+    logging.info("{} of {} sessions succeeded".format(int((report_df["status"] == "ok").sum()), len(session_list)))
+    return feature_df, report_df
+
+
+def run_feature_mission(mission_json: dict):
+    """
+    load the data of a feature_extraction mission and extract its features, with windows if the mission has
+    windows or window_size
+    :param mission_json: the items of the mission, output_path is optional
+    :return: the DataFrame of the features
+    """
+    pozyx_device_id = mission_json["pozyx_device_id"]
+    audio_data_path = mission_json["audio_data_path"]
+    formation_path = mission_json.get("formation_path", [])
+    feature_list = mission_json["feature"]
+    audio_start_timestamp = float(mission_json["audio_start_timestamp"])
+    session_name = str(mission_json["session_name"])
+    merging_threshold = float(mission_json["segment_merging_threshold"])
+    connected_threshold = float(mission_json["connected_threshold"])
+    output_path = mission_json.get("output_path")
+    formation_ratio = float(mission_json.get("formation_ratio", 0.7))
+    formation_alignment = str(mission_json.get("formation_alignment", "second"))
+    cache_dir = mission_json.get("cache_dir")
+    max_cache_bytes = int(float(mission_json.get("cache_size_mb", 2048)) * 1024 * 1024)
+    # f-formation的文件就是talk to relation,
+    audio_data_dict = {}
+    formation_data_dict = {}
+
+    for i, a_path in enumerate(audio_data_path):
+        audio_data_dict[pozyx_device_id[i]] = pd.read_csv(a_path)
+    if "formation_store" in mission_json:
+        formation_data_dict = FormationStore(str(mission_json["formation_store"]))
+    else:
+        for i, a_path in enumerate(formation_path):
+            formation_data_dict[pozyx_device_id[i]] = pd.read_csv(a_path)
+
+    if "windows" in mission_json or "window_size" in mission_json:
+        if mission_json.get("dyadic_output_path") is not None:
+            logging.warning("dyadic_output_path is not supported with windows, no dyadic csv is written for "
+                            "session '{}'".format(session_name))
+        window_list = None
+        if "windows" in mission_json:
+            window_list = [(a_window["name"], float(a_window["start"]), float(a_window["end"]))
+                           for a_window in mission_json["windows"]]
+        window_size = mission_json.get("window_size")
+        window_stride = mission_json.get("window_stride")
+        return feature_extraction_windows(audio_data_dict, formation_data_dict, pozyx_device_id,
+                                          audio_start_timestamp, connected_threshold, merging_threshold,
+                                          feature_list, session_name, output_path, window_list=window_list,
+                                          window_size=None if window_size is None else float(window_size),
+                                          window_stride=None if window_stride is None else float(window_stride),
+                                          formation_ratio=formation_ratio, formation_alignment=formation_alignment,
+                                          cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+
+    return feature_extraction(audio_data_dict, formation_data_dict, pozyx_device_id,
+                              audio_start_timestamp, connected_threshold, merging_threshold, feature_list,
+                              session_name, output_path, formation_ratio=formation_ratio,
+                              dyadic_output_path=mission_json.get("dyadic_output_path"),
+                              formation_alignment=formation_alignment, cache_dir=cache_dir,
+                              max_cache_bytes=max_cache_bytes)
+
+
+###################################################################
+# code below may not be useful if you only want to apply the code #
+###################################################################
+
+def _run_session(session: dict):
+    """
+    run in a worker process, it never raises
+    :return: (feature DataFrame or None, run time in seconds, error traceback or None)
+    """
+    start_time = time.perf_counter()
+    try:
+        feature_df = run_feature_mission(session)
+        return feature_df, time.perf_counter() - start_time, None
+    except Exception:
+        return None, time.perf_counter() - start_time, traceback.format_exc()
+
+
+def _run_session_isolated(session: dict):
+    """run a session in a process of its own, so if the process dies only this session fails"""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(_run_session, session).result()
+        except Exception:
+            # the worker itself died, like killed for lack of memory
+            return None, 0.0, traceback.format_exc()
+
+
+def _log_session_result(i: int, session: dict, a_result: tuple):
+    if a_result[2] is None:
+        logging.info("session {} ({}) done in {:.2f} s".format(i, session.get("session_name"), a_result[1]))
+    else:
+        logging.warning("session {} ({}) failed: {}".format(i, session.get("session_name"),
+                                                            a_result[2].strip().split("\n")[-1]))
+
+
+def _get_feature_table(result_list: list):
+    """the features of the sessions that succeeded, one after the other in the order of the manifest"""
+    df_list = []
+    for i, (feature_df, run_time, error) in enumerate(result_list):
+        if feature_df is not None:
+            feature_df = feature_df.copy()
+            feature_df.insert(0, "session_index", i)
+            df_list.append(feature_df)
+    if len(df_list) == 0:
+        return pd.DataFrame({"session_index": [], "device_id": [], "session_name": []})
+    # sessions with other features leave empty cells in the columns they do not have
+    return pd.concat(df_list, ignore_index=True, sort=False)
+
+
+def _get_report_dataframe(session_list: list, default_dict: dict, result_list: list):
+    result_dict = {"session_index": [], "session_name": [], "status": [], "seconds": [], "error": []}
+    for i, (feature_df, run_time, error) in enumerate(result_list):
+        result_dict["session_index"].append(i)
+        result_dict["session_name"].append(dict(default_dict, **session_list[i]).get("session_name"))
+        result_dict["status"].append("ok" if error is None else "failed")
+        result_dict["seconds"].append(run_time)
+        result_dict["error"].append("" if error is None else error.strip().split("\n")[-1])
+    return pd.DataFrame(result_dict)
@@ -0,0 +1,60 @@
+"""
+On-disk cache of the intermediate results of feature extraction.
+Each entry is a .npz file of named arrays, keyed by the hash of the inputs it was computed from, like the merged
+segments of a participant or the results of a pair of participants. The folder is handled by disk_cache.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from positioning_handler.disk_cache import evict_entries, touch_entry, write_entry
+
+
+class FeatureCache(object):
+    """
+    The entries of a cache folder.
+    hits and misses count the lookups since the cache was opened.
+    """
+
+    def __init__(self, cache_dir: str, max_cache_bytes: int = 2 * 1024 ** 3):
+        """
+        :param cache_dir: folder of the cache, created if it does not exist
+        :param max_cache_bytes: size budget of the folder, applied when the cache is closed
+        """
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, kind: str, key: str):
+        """
+        :param kind: the kind of entry, like "segments" or "pair", used as the prefix of the file name
+        :return: a dict of name -> array, None if the entry is not in the cache
+        """
+        entry_path = self._get_entry_path(kind, key)
+        try:
+            with np.load(entry_path) as entry:
+                array_dict = {a_name: entry[a_name] for a_name in entry.files}
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        touch_entry(entry_path)
+        return array_dict
+
+    def put(self, kind: str, key: str, array_dict: dict):
+        """save a dict of name -> array"""
+        def _write(temp_path):
+            with open(temp_path, "wb") as f:
+                np.savez(f, **array_dict)
+        write_entry(self._get_entry_path(kind, key), _write)
+
+    def close(self):
+        logging.info("feature cache: {} hits, {} misses".format(self.hits, self.misses))
+        evict_entries(self.cache_dir, self.max_cache_bytes, cache_name="feature cache")
+
+    def _get_entry_path(self, kind: str, key: str):
+        return os.path.join(self.cache_dir, "{}_{}.npz".format(kind, key))
@@ -1,72 +1,379 @@
+import bisect
+import heapq
+import itertools
 import logging
 import math
 
+import numpy as np
 import pandas as pd
 
+from positioning_handler.disk_cache import get_cache_key
+from positioning_handler.feature_cache import FeatureCache
+from positioning_handler.formation_store import FormationStore
+from positioning_handler.interval_set import IntervalSet
+
 
 def feature_extraction(audio_data_dict: dict, f_foramtion_data_dict: dict, id_list: list,
                        audio_start_timestamp: float, connected_threshold: float, merging_threshold: float,
-                       feature_list: list, session_name: str, output_path: str):
+                       feature_list: list, session_name: str, output_path: str, formation_ratio: float = 0.7,
+                       dyadic_output_path: str = None, formation_alignment: str = "second", cache_dir: str = None,
+                       max_cache_bytes: int = 2 * 1024 ** 3):
+    """
+    :param f_foramtion_data_dict: dict of device id -> DataFrame of the formation csv of the device,
+     or a FormationStore holding the formation of the session
+    :param formation_ratio: a participant is in formation with the speaker of a segment if they are in formation
+     for at least this share of the seconds of the segment
+    :param dyadic_output_path: if given, the speaker-listener matrices of the overlapped and connected features,
+     and the matrix of turn transitions (who speaks after whom), are written to this path
+    :param formation_alignment: "second" counts the whole seconds around a segment that are in formation, it
+     expects formation rows on whole seconds. "time" measures the time of the segment in formation, each formation
+     row lasting until the next one, so the formation can have any rate, like 10 rows per second
+    :param cache_dir: if given, the intermediate results of each participant and each pair of participants are
+     kept in this folder, so a new run where the data of one participant changed only recomputes the pairs
+     involving this participant
+    :param max_cache_bytes: size budget of cache_dir
+    :return: a DataFrame with a row for each device, also written to output_path unless it is None
+    """
+    dyadic_dict = None if dyadic_output_path is None else {}
+    segment_feature_dict = _get_segment_feature_dict(audio_data_dict, f_foramtion_data_dict, id_list,
+                                                     audio_start_timestamp, connected_threshold, merging_threshold,
+                                                     feature_list, formation_ratio, dyadic_dict,
+                                                     formation_alignment, cache_dir, max_cache_bytes)
+
+    feature_dict = {}
+    for a_column in _get_feature_columns(feature_list):
+        feature_dict[a_column] = [sum(segment_feature_dict[an_id][a_column]) for an_id in id_list]
+
+    result_dict = {"device_id": id_list, "session_name": [session_name for _ in range(len(id_list))]}
+    for a_key in feature_dict.keys():
+        result_dict[a_key] = feature_dict[a_key]
+    result_df = pd.DataFrame(result_dict)
+    if output_path is not None:
+        result_df.to_csv(output_path)
+
+    if dyadic_output_path is not None:
+        transitions = dyadic_dict.pop("turn_transition")
+        _get_dyadic_dataframe(dyadic_dict, transitions, id_list, session_name).to_csv(dyadic_output_path)
+    return result_df
+
+
+def feature_extraction_windows(audio_data_dict: dict, f_foramtion_data_dict: dict, id_list: list,
+                               audio_start_timestamp: float, connected_threshold: float, merging_threshold: float,
+                               feature_list: list, session_name: str, output_path: str, window_list: list = None,
+                               window_size: float = None, window_stride: float = None,
+                               formation_ratio: float = 0.7, formation_alignment: str = "second",
+                               cache_dir: str = None, max_cache_bytes: int = 2 * 1024 ** 3):
     """
-    :return:
+    The features of several time windows of a session, like the phases of an activity or rolling windows for a
+    dashboard, from one load of the data.
+    The features of every segment are computed once for the whole session, and a segment counts in the windows
+    where it starts. The totals of a window are the differences of cumulative sums over the segments sorted by
+    start, so each window costs two binary searches.
+    As the session is processed as a whole, a segment close to a window border can be connected to (or overlapped
+    by) a segment of the window next to it, which is not the case if each phase is cut into separate files.
+
+    The other parameters are the same as feature_extraction.
+    :param window_list: list of (name, start, end) in seconds from the start of the audio
+    :param window_size: length of the rolling windows in seconds, used when window_list is not given
+    :param window_stride: seconds between the starts of two rolling windows, window_size by default
+    :return: a DataFrame with a row for each window and device, also written to output_path unless it is None
     """
+    if window_list is None:
+        if window_size is None:
+            raise ValueError("either window_list or window_size should be given")
+        if window_size <= 0:
+            raise ValueError("window_size should be positive, received {}".format(window_size))
+        if window_stride is not None and window_stride <= 0:
+            raise ValueError("window_stride should be positive, received {}".format(window_stride))
+
+    segment_feature_dict = _get_segment_feature_dict(audio_data_dict, f_foramtion_data_dict, id_list,
+                                                     audio_start_timestamp, connected_threshold, merging_threshold,
+                                                     feature_list, formation_ratio,
+                                                     formation_alignment=formation_alignment, cache_dir=cache_dir,
+                                                     max_cache_bytes=max_cache_bytes)
+    if window_list is None:
+        window_list = _get_rolling_windows(segment_feature_dict, window_size, window_stride)
+    column_list = _get_feature_columns(feature_list)
+
+    result_dict = {"window": [], "window_start": [], "window_end": [], "device_id": [], "session_name": []}
+    for a_column in column_list:
+        result_dict[a_column] = []
+
+    window_starts = np.array([a_window[1] for a_window in window_list], dtype=float)
+    window_ends = np.array([a_window[2] for a_window in window_list], dtype=float)
+    # id -> column -> the value of each window
+    window_value_dict = {}
+    for an_id in id_list:
+        column_dict = segment_feature_dict[an_id]
+        segment_starts = np.asarray(column_dict["segment_start"], dtype=float)
+        lower = np.searchsorted(segment_starts, window_starts, side="left")
+        upper = np.searchsorted(segment_starts, window_ends, side="left")
+
+        window_value_dict[an_id] = {}
+        for a_column in column_list:
+            cumulative_sum = np.concatenate(([0], np.cumsum(column_dict[a_column])))
+            window_value_dict[an_id][a_column] = (cumulative_sum[upper] - cumulative_sum[lower]).tolist()
+
+    for i, a_window in enumerate(window_list):
+        for an_id in id_list:
+            result_dict["window"].append(a_window[0])
+            result_dict["window_start"].append(a_window[1])
+            result_dict["window_end"].append(a_window[2])
+            result_dict["device_id"].append(an_id)
+            result_dict["session_name"].append(session_name)
+            for a_column in column_list:
+                result_dict[a_column].append(window_value_dict[an_id][a_column][i])
+
+    result_df = pd.DataFrame(result_dict)
+    if output_path is not None:
+        result_df.to_csv(output_path)
+    return result_df
+
+
+###################################################################
+# code below may not be useful if you only want to apply the code #
+###################################################################
+
+def _get_segment_feature_dict(audio_data_dict: dict, f_foramtion_data_dict, id_list: list,
+                              audio_start_timestamp: float, connected_threshold: float, merging_threshold: float,
+                              feature_list: list, formation_ratio: float, dyadic_dict: dict = None,
+                              formation_alignment: str = "second", cache_dir: str = None,
+                              max_cache_bytes: int = 2 * 1024 ** 3):
+    """
+    merge the segments of every participant, then compute the features of each segment
+    :param cache_dir: if given, the merged segments of each participant and the results of each pair of
+     participants are saved in this folder, keyed by their inputs, and only the missing ones are computed
+    :param max_cache_bytes: size budget of cache_dir
+    :param formation_alignment: "second" to look up the formation at the whole seconds around a segment,
+     or "time" to measure the share of the time of the segment in formation, for formation data at any rate
+    :param dyadic_dict: if given, it is filled with the speaker-listener matrices of the features involving a
+     listener, and the turn transitions under "turn_transition"
+    """
+    cache = None if cache_dir is None else FeatureCache(cache_dir, max_cache_bytes)
     # preprocessing the audio segments data
-    result_dict = {"id": id_list, }
     segment_dict = {}
+    segment_key_dict = {}
     for i in range(len(id_list)):
         a_segment_list = []
 
         for index, line in audio_data_dict[id_list[i]].iterrows():
             a_segment_list.append((line["voice_start"], line["voice_end"]))
 
-        a_segment_list = _merging_small_segments(a_segment_list, merging_threshold)
+        if cache is None:
+            a_segment_list = _merging_small_segments(a_segment_list, merging_threshold)
+        else:
+            a_segment_list, segment_key_dict[id_list[i]] = _load_merged_segments_cached(
+                a_segment_list, merging_threshold, cache)
         segment_dict[id_list[i]] = a_segment_list
 
+    if formation_alignment == "second":
+        formation_index = _FormationIndex(f_foramtion_data_dict, formation_ratio)
+    elif formation_alignment == "time":
+        formation_index = _TimeFormationIndex(f_foramtion_data_dict, formation_ratio)
+    else:
+        raise ValueError("formation_alignment should be 'second' or 'time', received '{}'"
+                         .format(formation_alignment))
+    segment_index_dict = {an_id: _SegmentIndex(segment_dict[an_id]) for an_id in id_list}
+
     # start to extract data
-    feature_dict = {}
     for a_feature in feature_list:
-        if a_feature in ("overlapped", "connected", "to_other"):
-            feature_dict[a_feature + "_count"] = []
-            feature_dict[a_feature + "_duration"] = []
-        elif a_feature == "speaking_time":
-            feature_dict[a_feature + "_duration"] = []
-        else:
+        if a_feature not in _SEGMENT_FEATURES:
             logging.warning("unexpected feature in given feature list for extraction, received '{}'".format(a_feature))
 
-    for i, an_id in enumerate(id_list):
-        target_segment_dict = _get_target_segment_dict(an_id, segment_dict)
+    pair_result_dict = None
+    if cache is not None:
+        pair_result_dict = _load_pair_results_cached(segment_dict, segment_key_dict, id_list, formation_index,
+                                                     segment_index_dict, audio_start_timestamp, connected_threshold,
+                                                     cache)
+        cache.close()
+
+    if dyadic_dict is not None:
+        dyadic_dict["turn_transition"] = _get_turn_transitions(segment_dict, id_list)
+    return _extract_segment_features(segment_dict, id_list, formation_index, segment_index_dict,
+                                     audio_start_timestamp, connected_threshold, feature_list, dyadic_dict,
+                                     pair_result_dict)
+
+
+def _get_rolling_windows(segment_feature_dict: dict, window_size: float, window_stride: float = None):
+    """windows of window_size every window_stride seconds, from 0 to the end of the last segment"""
+    if window_stride is None:
+        window_stride = window_size
+    last_end = max([max(column_dict["segment_end"], default=0) for column_dict in segment_feature_dict.values()],
+                   default=0)
+    window_list = []
+    for i, a_start in enumerate(np.arange(0, last_end, window_stride).tolist()):
+        window_list.append((i, a_start, a_start + window_size))
+    return window_list
+
+
+class _SegmentIndex(object):
+    """
+    The segments of a speaker sorted by start, for finding the segments near a time range with binary search
+    instead of comparing with every segment.
+    """
 
-        if "overlapped" in feature_list:
-            olp_result = _get_overlap_data(segment_dict[an_id], an_id, audio_start_timestamp, target_segment_dict,
-                                           f_foramtion_data_dict)
-            feature_dict["overlapped_count"].append(olp_result[0])
-            feature_dict["overlapped_duration"].append(olp_result[1])
+    # the ranges are widened a little, so a segment right at the border is never lost to float rounding
+    _SLACK = 1e-6
 
-        if "connected" in feature_list:
-            con_result = _get_connect_data(segment_dict[an_id], an_id, audio_start_timestamp, target_segment_dict,
-                                           f_foramtion_data_dict, connected_threshold)
-            feature_dict["connected_count"].append(con_result[0])
-            feature_dict["connected_duration"].append(con_result[1])
+    def __init__(self, segment_list: list):
+        self.segments = sorted(segment_list, key=lambda a_segment: a_segment[0])
+        self.starts = [a_segment[0] for a_segment in self.segments]
+        # the running maximum of the ends is sorted even if some segments overlap
+        self.max_ends = list(itertools.accumulate((a_segment[1] for a_segment in self.segments), max))
 
-        if "speaking_time" in feature_list:
-            spk_result = _get_speaking_time(segment_dict[an_id])
-            feature_dict["speaking_time_duration"].append(spk_result)
+    def candidates(self, start: float, end: float):
+        """the segments that overlap or touch [start, end]"""
+        start -= self._SLACK
+        end += self._SLACK
+        lower = bisect.bisect_left(self.max_ends, start)
+        upper = bisect.bisect_right(self.starts, end)
+        return [a_segment for a_segment in self.segments[lower:upper] if a_segment[1] >= start]
 
-        if "to_other" in feature_list:
-            oth_result = _get_to_other_data(segment_dict[an_id], an_id, audio_start_timestamp, target_segment_dict,
-                                            f_foramtion_data_dict, connected_threshold)
-            feature_dict["to_other_count"].append(oth_result[0])
-            feature_dict["to_other_duration"].append(oth_result[1])
 
-    result_dict = {"device_id": id_list, "session_name": [session_name for _ in range(len(id_list))]}
-    for a_key in feature_dict.keys():
-        result_dict[a_key] = feature_dict[a_key]
-    pd.DataFrame(result_dict).to_csv(output_path)
+class _FormationIndex(object):
+    """
+    Cumulative sums of the formation flags of each pair over the whole seconds the pair has rows for,
+    so the number of seconds in formation inside any range is the difference of two values found with binary search.
+    The sums of a pair are built the first time the pair is asked for, and their size follows the rows of the pair
+    whatever the time span of the data.
+    """
 
+    def __init__(self, f_formation_data, ratio: float = 0.7):
+        """
+        :param f_formation_data: dict of device id -> DataFrame of the formation csv, or a FormationStore
+        :param ratio: the share of the seconds of a segment that should be in formation
+        """
+        self.f_formation_data = f_formation_data
+        self.ratio = ratio
+        if isinstance(f_formation_data, FormationStore):
+            self.ids = list(f_formation_data.ids)
+        else:
+            self.ids = list(f_formation_data.keys())
+        self._cumulative_sums = {}
+
+    def segment_partners(self, main_id, start_timestamp: float, end_timestamp: float, target_ids=None):
+        """ids of the participants in formation with main_id during a segment, in unix time"""
+        return self.partners(main_id, math.floor(start_timestamp), math.ceil(end_timestamp), target_ids)
+
+    def partners(self, main_id, start_timestamp: int, end_timestamp: int, target_ids=None):
+        """
+        ids of the participants in formation with main_id for at least ratio of the seconds [start, end]
+        :param target_ids: if given, only these participants are checked
+        """
+        target_timestamp_count = end_timestamp - start_timestamp + 1
+
+        result_list = []
+        for an_id in self.ids:
+            if an_id != main_id and (target_ids is None or an_id in target_ids):
+                seconds, cumulative_sum = self._get_cumulative_sum(main_id, an_id)
+                start = np.searchsorted(seconds, start_timestamp, side="left")
+                end = np.searchsorted(seconds, end_timestamp, side="right")
+                has_formtion_count = cumulative_sum[end] - cumulative_sum[start]
+                if has_formtion_count >= target_timestamp_count * self.ratio:
+                    result_list.append(an_id)
+        return result_list
+
+    def pair_fingerprint(self, main_id, an_id):
+        """the bytes of the formation data the partner lookup of a pair depends on, empty if a device is missing"""
+        if main_id not in self.ids or an_id not in self.ids:
+            return b""
+        timestamps, values = self._get_pair_flags(main_id, an_id)
+        return np.asarray(timestamps, dtype=float).tobytes() + np.asarray(values, dtype=float).tobytes()
+
+    def _get_cumulative_sum(self, main_id, an_id):
+        """the sorted whole seconds of the rows of the pair, and the cumulative sum of their formation flags"""
+        if (main_id, an_id) not in self._cumulative_sums:
+            timestamps, values = self._get_pair_flags(main_id, an_id)
+            # only the timestamps on whole seconds can match the seconds of a segment
+            on_second = timestamps == np.floor(timestamps)
+            timestamps = timestamps[on_second].astype(np.int64)
+            values = values[on_second]
+            # a second is looked up in the first row holding it
+            seconds, first_row = np.unique(timestamps, return_index=True)
+            flags = (values[first_row] == 1).astype(np.int64)
+            self._cumulative_sums[(main_id, an_id)] = (seconds, np.concatenate(([0], np.cumsum(flags))))
+        return self._cumulative_sums[(main_id, an_id)]
+
+    def _get_pair_flags(self, main_id, an_id):
+        """timestamps of the rows of main_id, and the formation flag of an_id at these rows"""
+        if isinstance(self.f_formation_data, FormationStore):
+            present = self.f_formation_data.present_flags(main_id)
+            timestamps = np.asarray(self.f_formation_data.timestamps)[present]
+            return timestamps, self.f_formation_data.pair_flags(main_id, an_id)[present].astype(int)
+        formation_df = self.f_formation_data[main_id]
+        return np.asarray(formation_df["timestamp"], dtype=float), np.asarray(formation_df[str(an_id)])
+
+
+class _TimeFormationIndex(_FormationIndex):
+    """
+    Formation of each pair as a step function of time, for formation data at any rate, regular or not.
+    Each row holds its flag until the next row, but no longer than the usual interval between the rows of the
+    pair, so a gap in the data counts as not in formation.
+    The time in formation inside any range is found with two binary searches in the cumulative time in formation.
+    """
+
+    def __init__(self, f_formation_data, ratio: float = 0.7):
+        """
+        :param f_formation_data: dict of device id -> DataFrame of the formation csv, or a FormationStore
+        :param ratio: the share of the time of a segment that should be in formation
+        """
+        self.f_formation_data = f_formation_data
+        self.ratio = ratio
+        if isinstance(f_formation_data, FormationStore):
+            self.ids = list(f_formation_data.ids)
+        else:
+            self.ids = list(f_formation_data.keys())
+        self._tracks = {}
+
+    def segment_partners(self, main_id, start_timestamp: float, end_timestamp: float, target_ids=None):
+        """
+        ids of the participants in formation with main_id for at least ratio of the time of a segment
+        :param target_ids: if given, only these participants are checked
+        """
+        result_list = []
+        for an_id in self.ids:
+            if an_id != main_id and (target_ids is None or an_id in target_ids):
+                timestamps, flags, holds, cumulative_time = self._get_track(main_id, an_id)
+                if end_timestamp > start_timestamp:
+                    in_formation_time = (_get_time_in_formation(timestamps, flags, holds, cumulative_time,
+                                                                end_timestamp)
+                                         - _get_time_in_formation(timestamps, flags, holds, cumulative_time,
+                                                                  start_timestamp))
+                    is_partner = in_formation_time >= (end_timestamp - start_timestamp) * self.ratio
+                else:
+                    # an empty segment takes the flag of the row covering it
+                    i = bisect.bisect_right(timestamps, start_timestamp) - 1
+                    is_partner = i >= 0 and flags[i] and start_timestamp - timestamps[i] <= holds[i]
+                if is_partner:
+                    result_list.append(an_id)
+        return result_list
+
+    def _get_track(self, main_id, an_id):
+        if (main_id, an_id) not in self._tracks:
+            timestamps, values = self._get_pair_flags(main_id, an_id)
+            order = np.argsort(timestamps, kind="stable")
+            # a time is looked up in the first row holding it
+            timestamps, first_row = np.unique(timestamps[order], return_index=True)
+            flags = values[order][first_row] == 1
+
+            intervals = np.diff(timestamps)
+            usual_interval = float(np.median(intervals)) if len(intervals) else 1.0
+            holds = np.minimum(np.append(intervals, usual_interval), usual_interval)
+            cumulative_time = np.concatenate(([0], np.cumsum(holds * flags)))
+            self._tracks[(main_id, an_id)] = (timestamps.tolist(), flags.tolist(), holds.tolist(),
+                                              cumulative_time.tolist())
+        return self._tracks[(main_id, an_id)]
+
+
+def _get_time_in_formation(timestamps: list, flags: list, holds: list, cumulative_time: list, a_time: float):
+    """the time in formation from the first row of a track to a_time"""
+    i = bisect.bisect_right(timestamps, a_time) - 1
+    if i < 0:
+        return 0
+    if not flags[i]:
+        return cumulative_time[i]
+    return cumulative_time[i] + min(a_time - timestamps[i], holds[i])
 
-###################################################################
-# code below may not be useful if you only want to apply the code #
-###################################################################
 
 def _merging_small_segments(segment_list: list, threshold: float):
     """
@@ -75,95 +382,294 @@ def _merging_small_segments(segment_list: list, threshold: float):
     :param threshold: threshold to do the merge
     :return: a merged segment list
     """
-    merged_list = []
-    merging_buffer_pos = []
-    for i in range(len(segment_list)):
-        if len(merging_buffer_pos) == 0:
-            merging_buffer_pos.append(segment_list[i][0])
-            merging_buffer_pos.append(segment_list[i][1])
-        else:
-            if segment_list[i][0] - merging_buffer_pos[1] < threshold:
-                merging_buffer_pos[1] = segment_list[i][1]
-            else:
-                merged_list.append(merging_buffer_pos)
-                merging_buffer_pos = []
-                merging_buffer_pos.append(segment_list[i][0])
-                merging_buffer_pos.append(segment_list[i][1])
+    return IntervalSet.from_segments(segment_list).merge_gaps(threshold).to_list()
 
-    if len(merging_buffer_pos) != 0:
-        merged_list.append(merging_buffer_pos)
 
-    return merged_list
+def _determine_who_in_formation_with_main(main_segment, main_id, audio_start_timestamp: float,
+                                          formation_index: _FormationIndex, target_ids=None):
+    """
+    determine which participants are creating f_formation with the participant who made this utterance
+    (expressed with main segment)
+    """
+    return formation_index.segment_partners(main_id, main_segment[0] + audio_start_timestamp,
+                                            main_segment[1] + audio_start_timestamp, target_ids)
 
 
-def _get_connect_data(main_segment_list: list, main_id, audio_start_timestamp: float, target_segment_dict: dict,
-                      f_formation_dict: dict, connected_thres: float = 1.5):
-    """the function to extract connected data """
-    connected_count = 0
-    connected_duration = 0
+class _SegmentContext(object):
+    """
+    What the features need to know about a segment of the main speaker.
+    The formation partners and the neighbouring segments of each partner are found once, when first used,
+    and shared by all the features of the segment.
+    """
 
-    for a_segment in main_segment_list:
-        a_result = _determine_connect_data(a_segment, target_segment_dict, main_id, audio_start_timestamp,
-                                           f_formation_dict, connected_thres)
-        connected_count += a_result[0]
-        connected_duration += a_result[1]
+    def __init__(self, main_segment, main_id, audio_start_timestamp: float, target_segment_dict: dict,
+                 formation_index: _FormationIndex, connected_thres: float):
+        self.main_segment = main_segment
+        self.main_id = main_id
+        self.audio_start_timestamp = audio_start_timestamp
+        self.target_segment_dict = target_segment_dict
+        self.formation_index = formation_index
+        self.connected_thres = connected_thres
+        self._formation_target_list = None
+        self._neighbour_dict = None
+        # intermediate results shared by the features, like the overlapped parts of each partner
+        self.cache = {}
+
+    @property
+    def formation_target_list(self):
+        """ids of the participants in formation with the main speaker during the segment"""
+        if self._formation_target_list is None:
+            self._formation_target_list = _determine_who_in_formation_with_main(
+                self.main_segment, self.main_id, self.audio_start_timestamp, self.formation_index,
+                self.target_segment_dict)
+        return self._formation_target_list
+
+    @property
+    def neighbour_dict(self):
+        """
+        the segments of each formation partner that overlap or are within connected_thres of the main segment,
+        in the order of target_segment_dict. Every feature only looks at these segments.
+        """
+        if self._neighbour_dict is None:
+            padding = max(self.connected_thres, 0)
+            self._neighbour_dict = {}
+            for an_target_id in self.target_segment_dict.keys():
+                if an_target_id in self.formation_target_list:
+                    self._neighbour_dict[an_target_id] = self.target_segment_dict[an_target_id].candidates(
+                        self.main_segment[0] - padding, self.main_segment[1] + padding)
+        return self._neighbour_dict
+
+
+def _extract_segment_features(segment_dict: dict, id_list: list, formation_index: _FormationIndex,
+                              segment_index_dict: dict, audio_start_timestamp: float, connected_thres: float,
+                              feature_list: list, dyadic_dict: dict = None, pair_result_dict: dict = None):
+    """
+    visit each segment of each participant once, and compute all the requested features of the segment from
+    one shared _SegmentContext
+    :param pair_result_dict: if given, the results of _get_pair_result for every ordered pair of ids, the features
+     are then computed from them instead of looking at the segments of the partners
+    :param dyadic_dict: if given, it is filled with feature name -> {"count": array, "duration": array},
+     arrays of shape (N, N) with the speaker in the rows and the listener in the columns, in the order of id_list
+    :return: dict of id -> dict of column -> list with the value of each segment,
+     with "segment_start" and "segment_end" columns as well
+    """
+    feature_functions = [(a_feature, _SEGMENT_FEATURES[a_feature]) for a_feature in dict.fromkeys(feature_list)
+                         if a_feature in _SEGMENT_FEATURES]
+    dyadic_functions = []
+    if dyadic_dict is not None:
+        id_position = {an_id: i for i, an_id in enumerate(id_list)}
+        for a_feature in dict.fromkeys(feature_list):
+            if a_feature in _DYADIC_FEATURES:
+                dyadic_functions.append((a_feature, _DYADIC_FEATURES[a_feature]))
+                dyadic_dict[a_feature] = {"count": np.zeros((len(id_list), len(id_list)), dtype=int),
+                                          "duration": np.zeros((len(id_list), len(id_list)))}
 
-    return connected_count, connected_duration
+    result_dict = {}
+    for an_id in id_list:
+        target_segment_dict = _get_target_segment_dict(an_id, segment_index_dict)
+        column_dict = {"segment_start": [], "segment_end": []}
+        for a_column in _get_feature_columns(feature_list):
+            column_dict[a_column] = []
+
+        for segment_number, a_segment in enumerate(segment_dict[an_id]):
+            context = _SegmentContext(a_segment, an_id, audio_start_timestamp, target_segment_dict, formation_index,
+                                      connected_thres)
+            if pair_result_dict is not None:
+                _fill_context_cache(context, segment_number, pair_result_dict)
+            column_dict["segment_start"].append(a_segment[0])
+            column_dict["segment_end"].append(a_segment[1])
+            for a_feature, (a_function, suffix_list) in feature_functions:
+                for a_suffix, a_value in zip(suffix_list, a_function(context)):
+                    column_dict[a_feature + "_" + a_suffix].append(a_value)
+            for a_feature, a_function in dyadic_functions:
+                for an_target_id, a_count, a_duration in a_function(context):
+                    dyadic_dict[a_feature]["count"][id_position[an_id], id_position[an_target_id]] += a_count
+                    dyadic_dict[a_feature]["duration"][id_position[an_id], id_position[an_target_id]] += a_duration
+
+        result_dict[an_id] = column_dict
+    return result_dict
 
 
-def _determine_who_in_formation_with_main(main_segment, main_id, audio_start_timestamp: float, f_formation_dict):
+def _get_pair_result(main_id, an_target_id, segment_dict: dict, formation_index: _FormationIndex,
+                     segment_index_dict: dict, audio_start_timestamp: float, connected_thres: float):
     """
-    determine which participants are creating f_formation with the participant who made this utterance
-    (expressed with main segment)
+    what each segment of main_id gets from the segments of an_target_id: if they are in formation, the overlapped
+    parts, if it is connected to a segment of an_target_id, and if it is talking with an_target_id
+    :return: a dict of arrays with an entry per segment of main_id, the overlapped parts of the segment i are
+     [overlap_offsets[i], overlap_offsets[i + 1]) of overlap_starts and overlap_ends
     """
-    start_timestamp = math.floor(main_segment[0] + audio_start_timestamp)
-    end_timestamp = math.ceil(main_segment[1] + audio_start_timestamp)
-    target_timestamp_list = list(range(start_timestamp, end_timestamp + 1))
-    formation_df = f_formation_dict[main_id]
-
-    result_list = []
-    for an_id in f_formation_dict.keys():
-        if an_id != main_id:
-            a_df = formation_df[["timestamp", str(an_id)]]
-            has_formtion_count = 0
-
-            for a_timestamp in target_timestamp_list:
-                if a_timestamp in a_df["timestamp"].values:
-                    if a_df.loc[a_df["timestamp"] == a_timestamp].iloc[0][str(an_id)] == 1:
-                        has_formtion_count += 1
+    target_segment_dict = {an_target_id: segment_index_dict[an_target_id]}
+    partner_list = []
+    connected_list = []
+    engaged_list = []
+    overlap_offsets = [0]
+    overlap_starts = []
+    overlap_ends = []
+    for a_segment in segment_dict[main_id]:
+        context = _SegmentContext(a_segment, main_id, audio_start_timestamp, target_segment_dict, formation_index,
+                                  connected_thres)
+        partner_list.append(an_target_id in context.neighbour_dict)
+        connected_list.append(_get_connected_target(context) is not None)
+        engaged_list.append(_get_engaged_target(context) is not None)
+        for an_overlap in _get_overlapped_segment_dict(context).get(an_target_id, []):
+            overlap_starts.append(an_overlap[0])
+            overlap_ends.append(an_overlap[1])
+        overlap_offsets.append(len(overlap_starts))
+
+    return {
+        "partner": np.array(partner_list, dtype=bool),
+        "connected": np.array(connected_list, dtype=bool),
+        "engaged": np.array(engaged_list, dtype=bool),
+        "overlap_offsets": np.array(overlap_offsets, dtype=np.int64),
+        "overlap_starts": np.array(overlap_starts, dtype=float),
+        "overlap_ends": np.array(overlap_ends, dtype=float),
+    }
+
+
+def _fill_context_cache(context: _SegmentContext, segment_number: int, pair_result_dict: dict):
+    """put the results of the pairs of the main speaker in the context, so no feature looks at the segments"""
+    overlapped_segment_dict = {}
+    context.cache["connected_target"] = None
+    context.cache["engaged_target"] = None
+    for an_target_id in context.target_segment_dict.keys():
+        pair_result = pair_result_dict[(context.main_id, an_target_id)]
+        lower, upper = pair_result["overlap_offsets"][segment_number:segment_number + 2]
+        if upper > lower:
+            overlapped_segment_dict[an_target_id] = list(zip(pair_result["overlap_starts"][lower:upper],
+                                                             pair_result["overlap_ends"][lower:upper]))
+        # the features take the first partner in the order of the targets
+        if context.cache["connected_target"] is None and pair_result["connected"][segment_number]:
+            context.cache["connected_target"] = an_target_id
+        if context.cache["engaged_target"] is None and pair_result["engaged"][segment_number]:
+            context.cache["engaged_target"] = an_target_id
+    context.cache["overlapped_segment_dict"] = overlapped_segment_dict
+
+
+def _load_merged_segments_cached(segment_list: list, threshold: float, cache: FeatureCache):
+    """
+    the cached version of _merging_small_segments
+    :return: the merged segments, and the key of the entry
+    """
+    segment_array = np.asarray(segment_list, dtype=float).reshape(-1, 2)
+    key = get_cache_key(segment_array.tobytes(), repr(float(threshold)).encode())
+    entry = cache.get("segments", key)
+    if entry is not None:
+        return entry["segments"].tolist(), key
 
-            if has_formtion_count >= len(target_timestamp_list) * 0.7:
-                result_list.append(an_id)
+    merged_list = _merging_small_segments(segment_list, threshold)
+    cache.put("segments", key, {"segments": np.asarray(merged_list, dtype=float).reshape(-1, 2)})
+    return merged_list, key
 
-    return result_list
 
+def _load_pair_results_cached(segment_dict: dict, segment_key_dict: dict, id_list: list,
+                              formation_index: _FormationIndex, segment_index_dict: dict,
+                              audio_start_timestamp: float, connected_thres: float, cache: FeatureCache):
+    """
+    the results of _get_pair_result for every ordered pair of ids.
+    An entry is keyed by the merged segments of both ids, the formation of the pair and the settings, so when the
+    data of one participant changes, only the pairs involving this participant are computed again.
+    :return: dict of (main id, target id) -> dict of lists
+    """
+    setting_key = repr((type(formation_index).__name__, float(formation_index.ratio), float(audio_start_timestamp),
+                        float(connected_thres))).encode()
+    pair_result_dict = {}
+    computed_count = 0
+    for main_id in id_list:
+        for an_target_id in id_list:
+            if an_target_id == main_id:
+                continue
+            key = get_cache_key(str(main_id).encode(), str(an_target_id).encode(),
+                                segment_key_dict[main_id].encode(), segment_key_dict[an_target_id].encode(),
+                                formation_index.pair_fingerprint(main_id, an_target_id), setting_key)
+            pair_result = cache.get("pair", key)
+            if pair_result is None:
+                pair_result = _get_pair_result(main_id, an_target_id, segment_dict, formation_index,
+                                               segment_index_dict, audio_start_timestamp, connected_thres)
+                cache.put("pair", key, pair_result)
+                computed_count += 1
+            pair_result_dict[(main_id, an_target_id)] = {a_name: an_array.tolist()
+                                                         for a_name, an_array in pair_result.items()}
+
+    logging.info("feature cache: computed {} of {} pairs of participants".format(computed_count,
+                                                                                   len(pair_result_dict)))
+    return pair_result_dict
+
+
+def _get_turn_transitions(segment_dict: dict, id_list: list):
+    """
+    count who speaks after whom, with one chronological sweep over the merged segments of all the speakers
+    :return: an array of shape (N, N), the previous speaker in the rows and the next speaker in the columns
+    """
+    transitions = np.zeros((len(id_list), len(id_list)), dtype=int)
+    # the segments of each speaker are sorted already, so merging the lists keeps the chronological order
+    all_segments = heapq.merge(*[[(a_segment[0], a_segment[1], i) for a_segment in segment_dict[an_id]]
+                                 for i, an_id in enumerate(id_list)])
+    previous_speaker = None
+    for start, end, speaker in all_segments:
+        if previous_speaker is not None:
+            transitions[previous_speaker, speaker] += 1
+        previous_speaker = speaker
+    return transitions
+
+
+def _get_dyadic_dataframe(dyadic_dict: dict, transitions: np.ndarray, id_list: list, session_name: str):
+    """one block of rows for each dyadic feature, a row for each speaker and a column for each listener"""
+    block_list = [("turn_transition_count", transitions)]
+    for a_feature in dyadic_dict.keys():
+        block_list.append((a_feature + "_count", dyadic_dict[a_feature]["count"]))
+        block_list.append((a_feature + "_duration", dyadic_dict[a_feature]["duration"]))
+
+    result_dict = {"feature": [], "session_name": [], "device_id": []}
+    for an_id in id_list:
+        result_dict[an_id] = []
+    for a_name, a_matrix in block_list:
+        for i, an_id in enumerate(id_list):
+            result_dict["feature"].append(a_name)
+            result_dict["session_name"].append(session_name)
+            result_dict["device_id"].append(an_id)
+            for j, another_id in enumerate(id_list):
+                result_dict[another_id].append(a_matrix[i, j].item())
+    # the count and duration blocks share the listener columns, object columns keep the counts as ints
+    return pd.DataFrame(result_dict, dtype=object)
+
+
+def _get_feature_columns(feature_list: list):
+    """the output columns of the features, in the order of feature_list"""
+    column_list = []
+    for a_feature in dict.fromkeys(feature_list):
+        if a_feature in _SEGMENT_FEATURES:
+            for a_suffix in _SEGMENT_FEATURES[a_feature][1]:
+                column_list.append(a_feature + "_" + a_suffix)
+    return column_list
 
-def _determine_connect_data(main_segment, target_segment_dict: dict, main_id, audio_start_timestamp: float,
-                            f_formation_dict: dict, connected_thres: float = 1.5):
-    """the logic to detect connected speech"""
-    is_connected = False
-    connected_duration = 0
-    connected_count = 0
-    formation_target_list = _determine_who_in_formation_with_main(main_segment, main_id, audio_start_timestamp,
-                                                                  f_formation_dict)
 
-    # this list has nothing means the student is not forming formation but talking,
-    # it cannot create any connected speech in this situation
+def _get_target_segment_dict(main_id, segment_dict: dict):
+    """get a dict of the segments (or segment indexes) of every id except the currently investigating id"""
+    result_dict = {}
+    for an_id in segment_dict.keys():
+        if an_id != main_id:
+            result_dict[an_id] = segment_dict[an_id]
+    return result_dict
 
-    if len(formation_target_list) == 0:
-        return 0, 0
 
-    for an_target_id in target_segment_dict.keys():
-        if an_target_id not in formation_target_list:
-            continue
-        for a_segment in target_segment_dict[an_target_id]:
+def _get_connected_target(context: _SegmentContext):
+    """the id of the first partner the main segment is connected to, None if it is not a connected speech"""
+    if "connected_target" in context.cache:
+        return context.cache["connected_target"]
+    context.cache["connected_target"] = None
+    main_segment = context.main_segment
 
+    # no formation partner means the student is not forming formation but talking,
+    # it cannot create any connected speech in this situation
+    for an_target_id, candidate_segments in context.neighbour_dict.items():
+        for a_segment in candidate_segments:
             main0_tar0 = main_segment[0] - a_segment[0]
             main0_tar1 = main_segment[0] - a_segment[1]
             main1_tar0 = main_segment[1] - a_segment[0]
             main1_tar1 = main_segment[1] - a_segment[1]
             main_len = main_segment[1] - main_segment[0]
             tar_len = a_segment[1] - a_segment[0]
+            is_connected = False
 
             if main0_tar0 <= 0 and main0_tar1 < 0 and main1_tar0 > 0 and main1_tar1 >= 0:
                 is_connected = True
@@ -173,170 +679,111 @@ def _determine_connect_data(main_segment, target_segment_dict: dict, main_id, au
                     is_connected = True
 
             elif main0_tar0 <= 0 and main0_tar1 <= 0 and main1_tar0 <= 0 and main1_tar1 <= 0:
-                if a_segment[0] - main_segment[1] < connected_thres and main_len > tar_len:
+                if a_segment[0] - main_segment[1] < context.connected_thres and main_len > tar_len:
                     is_connected = True
 
             if is_connected:
-                connected_count += 1
-                connected_duration += main_len
-
-                return connected_count, connected_duration
+                context.cache["connected_target"] = an_target_id
+                return an_target_id
     # if it fits no situation listed above, it is not a connected speech
-    return 0, 0
-
-
-def _get_target_segment_dict(main_id, segment_dict: dict):
-    """get a segment list that contains a segment dict that does not contain the currently investigating id"""
-    result_dict = {}
-    for an_id in segment_dict.keys():
-        if an_id != main_id:
-            result_dict[an_id] = segment_dict[an_id]
-    return result_dict
-
-
-def _get_overlap_data(main_segment_list: list, main_id, audio_start_timestamp: float, target_segment_dict: dict,
-                      f_formation_dict: dict):
-    """the function to detect overlapped speech"""
-
-    overlap_count = 0
-    overlap_duration = 0
+    return None
 
-    for a_segment in main_segment_list:
-        a_result = _determine_overlap_data(a_segment, target_segment_dict, main_id, audio_start_timestamp,
-                                           f_formation_dict)
-        overlap_count += a_result[0]
-        overlap_duration += a_result[1]
 
-    return overlap_count, overlap_duration
-
-
-def _determine_overlap_data(main_segment, target_segment_dict: dict, main_id, audio_start_timestamp: float,
-                            f_formation_dict: dict):
+def _determine_connect_data(context: _SegmentContext):
     """the logic to detect connected speech"""
-    is_overlapped = False
-    overlapped_duration = 0
-    overlapped_count = 0
-    formation_target_list = _determine_who_in_formation_with_main(main_segment, main_id, audio_start_timestamp,
-                                                                  f_formation_dict)
-
-    # this list has nothing means the student is not forming formation but talking,
-    # it cannot create any connected speech in this situation
-
-    if len(formation_target_list) == 0:
+    if _get_connected_target(context) is None:
         return 0, 0
+    return 1, context.main_segment[1] - context.main_segment[0]
 
-    overlapped_segment_list = []
 
-    for an_target_id in target_segment_dict.keys():
-        if an_target_id not in formation_target_list:
-            continue
+def _determine_connect_pairs(context: _SegmentContext):
+    """the connected speech, credited to the partner it is connected to"""
+    an_target_id = _get_connected_target(context)
+    if an_target_id is None:
+        return []
+    return [(an_target_id, 1, context.main_segment[1] - context.main_segment[0])]
+
 
-        for a_segment in target_segment_dict[an_target_id]:
+def _get_overlapped_segment_dict(context: _SegmentContext):
+    """the overlapped parts of the main segment with the segments of each partner"""
+    if "overlapped_segment_dict" in context.cache:
+        return context.cache["overlapped_segment_dict"]
+    main_segment = context.main_segment
+    overlapped_segment_dict = {}
 
+    # no formation partner means the student is not forming formation but talking,
+    # it cannot create any overlapped speech in this situation
+    for an_target_id, candidate_segments in context.neighbour_dict.items():
+        overlapped_segment_list = []
+        for a_segment in candidate_segments:
             main0_tar0 = main_segment[0] - a_segment[0]
             main0_tar1 = main_segment[0] - a_segment[1]
             main1_tar0 = main_segment[1] - a_segment[0]
             main1_tar1 = main_segment[1] - a_segment[1]
 
             if main0_tar0 <= 0 and main0_tar1 < 0 and main1_tar0 > 0 and main1_tar1 >= 0:
-                is_overlapped = True
                 overlapped_segment_list.append((a_segment[0], a_segment[1]))
 
             elif main0_tar0 > 0 and main0_tar1 < 0 and main1_tar0 > 0 and main1_tar1 > 0:
-                is_overlapped = True
                 overlapped_segment_list.append((main_segment[0], a_segment[1]))
 
             elif main0_tar0 < 0 and main0_tar1 < 0 and main1_tar0 > 0 and main1_tar1 < 0:
-                is_overlapped = True
                 overlapped_segment_list.append((a_segment[0], main_segment[1]))
 
             elif main0_tar0 >= 0 and main0_tar1 <= 0 and main1_tar0 >= 0 and main1_tar1 <= 0:
                 # tar region is larger, so does not consider as overlapped
-                is_overlapped = True
                 overlapped_segment_list.append((main_segment[0], main_segment[1]))
+        if len(overlapped_segment_list) != 0:
+            overlapped_segment_dict[an_target_id] = overlapped_segment_list
+
+    context.cache["overlapped_segment_dict"] = overlapped_segment_dict
+    return overlapped_segment_dict
+
+
+def _determine_overlap_data(context: _SegmentContext):
+    """the logic to detect overlapped speech"""
+    overlapped_segment_list = []
+    for a_list in _get_overlapped_segment_dict(context).values():
+        overlapped_segment_list.extend(a_list)
     # because one segment can have overlap with multiple other segments,
-    if is_overlapped:
-        overlapped_count += 1
-        overlapped_duration += _get_overlapped_duration(overlapped_segment_list)
-        return overlapped_count, overlapped_duration
-    # if it fits no situation listed above, it is not a connected speech
+    if len(overlapped_segment_list) != 0:
+        return 1, _get_overlapped_duration(overlapped_segment_list)
+    # if it fits no situation listed above, it is not an overlapped speech
     return 0, 0
 
 
-def _merge_segments(list_to_merge: list):
-    """merge the segment that has overlap to a list of segments that do not have overlap"""
-    while True:
-        to_break = False
-        for i, a_segment in enumerate(list_to_merge):
-            for j, other_segment in enumerate(list_to_merge):
-                if a_segment is not other_segment:
-                    if a_segment[0] <= other_segment[1] and a_segment[1] >= other_segment[0]:
-                        list_to_merge.remove(a_segment)
-                        list_to_merge.remove(other_segment)
-                        list_to_merge.append((min(a_segment[0], other_segment[0]), max(a_segment[1], other_segment[1])))
-                        to_break = True
-                        break
-            if to_break:
-                break
-        if not to_break:
-            break
-    return list_to_merge
+def _determine_overlap_pairs(context: _SegmentContext):
+    """the overlapped speech, with the overlapped duration of each partner"""
+    return [(an_target_id, 1, _get_overlapped_duration(a_list))
+            for an_target_id, a_list in _get_overlapped_segment_dict(context).items()]
 
 
 def _get_overlapped_duration(overlapped_segment_list):
-    """get the length of segments in a segment list"""
-    new_list = _merge_segments(overlapped_segment_list)
-    duration = 0
-    for a_segment in new_list:
-        duration += (a_segment[1] - a_segment[0])
-    return duration
+    """get the length of time covered by the segments in a segment list"""
+    return IntervalSet.from_segments(overlapped_segment_list).union().duration
 
 
-def _get_speaking_time(main_segment_list):
+def _determine_speaking_time(context: _SegmentContext):
     """ calculating the speaking time"""
-    duration = 0
-    for a_segment in main_segment_list:
-        duration += (a_segment[1] - a_segment[0])
-    return duration
-
-
-def _get_to_other_data(main_segment_list: list, main_id, audio_start_timestamp: float, target_segment_dict: dict,
-                       f_formation_dict: dict, connected_thres: float = 1.5):
-    """function to get the speech to other (to_other) feature """
-    to_other_count = 0
-    to_other_duration = 0
+    return (context.main_segment[1] - context.main_segment[0],)
 
-    for a_segment in main_segment_list:
-        a_result = _determine_to_other_data(a_segment, target_segment_dict, main_id, audio_start_timestamp,
-                                            f_formation_dict, connected_thres)
-        to_other_count += a_result[0]
-        to_other_duration += a_result[1]
 
-    return to_other_count, to_other_duration
-
-
-def _determine_to_other_data(main_segment, target_segment_dict: dict, main_id, audio_start_timestamp: float,
-                             f_formation_dict: dict, connected_thres: float = 1.5):
-    """logic of get the speech to other"""
-    is_to_other = True
-    formation_target_list = _determine_who_in_formation_with_main(main_segment, main_id, audio_start_timestamp,
-                                                                  f_formation_dict)
-
-    # this list has nothing means the student is not forming formation but talking,
-    # it cannot create any connected speech in this situation
-
-    if len(formation_target_list) == 0:
-        return 1, (main_segment[1] - main_segment[0])
-
-    for an_target_id in target_segment_dict.keys():
-        if an_target_id not in formation_target_list:
-            continue
-        for a_segment in target_segment_dict[an_target_id]:
+def _get_engaged_target(context: _SegmentContext):
+    """the id of the first partner the main segment is talking with, None if it is a speech to other"""
+    if "engaged_target" in context.cache:
+        return context.cache["engaged_target"]
+    context.cache["engaged_target"] = None
+    main_segment = context.main_segment
+    connected_thres = context.connected_thres
 
+    # if the student is not forming formation with anyone, the speech is to someone out of the team
+    for an_target_id, candidate_segments in context.neighbour_dict.items():
+        for a_segment in candidate_segments:
             main0_tar0 = main_segment[0] - a_segment[0]
             main0_tar1 = main_segment[0] - a_segment[1]
             main1_tar0 = main_segment[1] - a_segment[0]
             main1_tar1 = main_segment[1] - a_segment[1]
+            is_to_other = True
 
             # all of the conditions below may indicate that the student is talking to someone inside the team
             if main0_tar0 <= 0 and main0_tar1 < 0 and main1_tar0 > 0 and main1_tar1 >= 0:
@@ -354,12 +801,36 @@ def _determine_to_other_data(main_segment, target_segment_dict: dict, main_id, a
                     a_segment[0] - main_segment[1] < connected_thres:
                 is_to_other = False
 
-
             elif main0_tar0 >= 0 and main0_tar1 >= 0 and main1_tar0 >= 0 and main1_tar1 >= 0 and \
                     main_segment[0] - a_segment[1] < connected_thres:
                 is_to_other = False
 
             if not is_to_other:
-                return 0, 0
-    # if it fits no situation listed above, it is not a connected speech
-    return 1, (main_segment[1] - main_segment[0])
+                context.cache["engaged_target"] = an_target_id
+                return an_target_id
+    return None
+
+
+def _determine_to_other_data(context: _SegmentContext):
+    """logic of get the speech to other"""
+    if _get_engaged_target(context) is not None:
+        return 0, 0
+    # if it fits no situation listed above, it is a speech to other
+    return 1, (context.main_segment[1] - context.main_segment[0])
+
+
+# feature name -> (function computing the values of a _SegmentContext, suffixes of the output columns).
+# A new feature only needs a function here, it is computed in the same pass as the others.
+_SEGMENT_FEATURES = {
+    "overlapped": (_determine_overlap_data, ("count", "duration")),
+    "connected": (_determine_connect_data, ("count", "duration")),
+    "speaking_time": (_determine_speaking_time, ("duration",)),
+    "to_other": (_determine_to_other_data, ("count", "duration")),
+}
+
+# feature name -> function giving the (partner id, count, duration) of a _SegmentContext, for the features that
+# involve a listener
+_DYADIC_FEATURES = {
+    "overlapped": _determine_overlap_pairs,
+    "connected": _determine_connect_pairs,
+}
@@ -0,0 +1,107 @@
+"""
+Compact storage of f-formation results.
+A session is saved in a folder holding the shared timestamp vector and one bit per pair of devices per timestamp,
+as .npy files that are memory-mapped when read, so a reader only decodes the part of the session it looks at.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+_META_FILE = "meta.json"
+
+
+def write_formation_store(store_path: str, id_list: list, timestamps: np.ndarray, present: np.ndarray,
+                          formation: np.ndarray, session_name: str):
+    """
+    save the result of f_formation.compute_formation
+    :param store_path: folder of the store, created if it does not exist
+    :param id_list: list of all the device ids, in the order of the formation array
+    :param timestamps: timestamps with shape (T,)
+    :param present: bool array of shape (N, T) telling if a device has data at a timestamp
+    :param formation: symmetric bool array of shape (N, N, T)
+    :param session_name: session name
+    """
+    os.makedirs(store_path, exist_ok=True)
+    first, second = np.triu_indices(len(id_list), k=1)
+
+    np.save(os.path.join(store_path, "timestamps.npy"), np.asarray(timestamps))
+    np.save(os.path.join(store_path, "present.npy"), np.packbits(present, axis=-1))
+    np.save(os.path.join(store_path, "pairs.npy"), np.packbits(formation[first, second], axis=-1))
+    with open(os.path.join(store_path, _META_FILE), "w") as f:
+        json.dump({"session_name": session_name, "ids": [int(an_id) for an_id in id_list]}, f)
+
+
+class FormationStore(object):
+    """Reader of a folder written by write_formation_store"""
+
+    def __init__(self, store_path: str):
+        with open(os.path.join(store_path, _META_FILE)) as f:
+            meta = json.load(f)
+        self.session_name = meta["session_name"]
+        self.ids = meta["ids"]
+        self.timestamps = np.load(os.path.join(store_path, "timestamps.npy"), mmap_mode="r")
+        self._present = np.load(os.path.join(store_path, "present.npy"), mmap_mode="r")
+        self._pairs = np.load(os.path.join(store_path, "pairs.npy"), mmap_mode="r")
+
+    def time_range(self, start_timestamp: float, end_timestamp: float):
+        """the indexes [start, end) of the timestamps inside [start_timestamp, end_timestamp]"""
+        return (int(np.searchsorted(self.timestamps, start_timestamp, side="left")),
+                int(np.searchsorted(self.timestamps, end_timestamp, side="right")))
+
+    def pair_flags(self, first_id, second_id, start: int = 0, end: int = None):
+        """
+        formation of two devices at the timestamps with indexes [start, end), only these bits are decoded
+        :return: a bool array
+        """
+        return _unpack_range(self._pairs[self._get_pair_index(first_id, second_id)], start, end,
+                             len(self.timestamps))
+
+    def present_flags(self, device_id, start: int = 0, end: int = None):
+        """if a device has data at the timestamps with indexes [start, end)"""
+        return _unpack_range(self._present[self.ids.index(device_id)], start, end, len(self.timestamps))
+
+    def to_dataframe(self, device_id):
+        """the legacy per-device format, the same as the csv written by f_formation.extract_formation"""
+        present = self.present_flags(device_id)
+        device_timestamps = np.asarray(self.timestamps)[present]
+
+        result_dict = {
+            "session_name": [self.session_name for _ in device_timestamps],
+            "timestamp": list(device_timestamps),
+        }
+        for an_id in self.ids:
+            if an_id == device_id:
+                result_dict[an_id] = [-1 for _ in device_timestamps]
+            else:
+                result_dict[an_id] = self.pair_flags(device_id, an_id)[present].astype(int)
+        return pd.DataFrame(result_dict)
+
+    def to_legacy_csv(self, device_id, output_path: str):
+        self.to_dataframe(device_id).to_csv(output_path)
+
+    def _get_pair_index(self, first_id, second_id):
+        """position of an unordered pair in the rows of np.triu_indices"""
+        i = self.ids.index(first_id)
+        j = self.ids.index(second_id)
+        if i > j:
+            i, j = j, i
+        if i == j:
+            raise ValueError("a device is not paired with itself, received '{}'".format(first_id))
+        return i * len(self.ids) - i * (i + 1) // 2 + (j - i - 1)
+
+
+###################################################################
+# code below may not be useful if you only want to apply the code #
+###################################################################
+
+def _unpack_range(packed_row: np.ndarray, start: int, end, length: int):
+    """decode the bits [start, end) of a row packed by np.packbits"""
+    if end is None:
+        end = length
+    if end <= start:
+        return np.zeros(0, dtype=bool)
+    bits = np.unpackbits(np.asarray(packed_row[start // 8:(end + 7) // 8]))
+    return bits[start % 8:start % 8 + end - start].astype(bool)
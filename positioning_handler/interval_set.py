@@ -0,0 +1,80 @@
+"""
+A set of time intervals, like the voiced segments of a speaker, kept in sorted numpy arrays.
+"""
+
+import numpy as np
+
+
+class IntervalSet(object):
+    """
+    Closed intervals [start, end] sorted by start.
+    The merging operations sort once and then work on the arrays, so they cost O(n log n).
+    """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        order = np.argsort(starts, kind="stable")
+        self.starts = starts[order]
+        self.ends = ends[order]
+
+    @classmethod
+    def from_segments(cls, segment_list: list):
+        """build from a list of (start, end) segments"""
+        if len(segment_list) == 0:
+            return cls([], [])
+        segment_array = np.asarray(segment_list, dtype=float)
+        return cls(segment_array[:, 0], segment_array[:, 1])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def to_list(self):
+        """the intervals as a list of [start, end]"""
+        return [[start, end] for start, end in zip(self.starts.tolist(), self.ends.tolist())]
+
+    @property
+    def duration(self):
+        """the summed length of the intervals, overlapping parts are counted as many times as they appear"""
+        if len(self) == 0:
+            return 0
+        # cumsum adds in order, the same as summing in a loop
+        return float(np.cumsum(self.ends - self.starts)[-1])
+
+    def merge_gaps(self, threshold: float):
+        """merge every interval into the previous one when the gap between them is less than threshold"""
+        return self._merge(self.starts[1:] - self._running_end()[:-1] >= threshold)
+
+    def union(self, other=None):
+        """merge the intervals that overlap or touch each other, together with the ones of other if given"""
+        if other is None:
+            return self._merge(self.starts[1:] > self._running_end()[:-1])
+        return IntervalSet(np.concatenate((self.starts, other.starts)),
+                           np.concatenate((self.ends, other.ends))).union()
+
+    def intersection(self, other):
+        """the parts of time covered by both sets, as a set of non-overlapping intervals"""
+        first = self.union()
+        second = other.union()
+        # the intervals of second overlapping each interval of first, found with binary search
+        lower = np.searchsorted(second.ends, first.starts, side="left")
+        upper = np.searchsorted(second.starts, first.ends, side="right")
+        counts = np.maximum(upper - lower, 0)
+        first_index = np.repeat(np.arange(len(first)), counts)
+        second_index = np.repeat(lower - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        starts = np.maximum(first.starts[first_index], second.starts[second_index])
+        ends = np.minimum(first.ends[first_index], second.ends[second_index])
+        keep = starts < ends
+        return IntervalSet(starts[keep], ends[keep])
+
+    def _running_end(self):
+        return np.maximum.accumulate(self.ends) if len(self) else self.ends
+
+    def _merge(self, is_new_group: np.ndarray):
+        """merge the runs of intervals, is_new_group tells if each interval except the first one starts a new run"""
+        if len(self) == 0:
+            return IntervalSet([], [])
+        group_first = np.flatnonzero(np.concatenate(([True], is_new_group)))
+        group_last = np.concatenate((group_first[1:] - 1, [len(self) - 1]))
+        return IntervalSet(self.starts[group_first], self._running_end()[group_last])
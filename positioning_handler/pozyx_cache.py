@@ -0,0 +1,100 @@
+"""
+On-disk cache of the parsed raw pozyx logs.
+Parsing a full-day log is the slowest part of interpolate_pozyx, so the parsed columns of every tag are saved as
+.npy files and memory-mapped on the next run instead of decoding the json again.
+An entry is a folder of .npy files, the cache folder is handled by disk_cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from positioning_handler.disk_cache import evict_entries, touch_entry, write_entry
+from positioning_handler.pozyx_extraction import log_parse_stats
+from positioning_handler.pozyx_extraction import parse_pozyx_log
+
+_COLUMNS = ("timestamp", "success", "x", "y", "yaw")
+_INDEX_FILE = "index.json"
+
+
+def load_pozyx_data_cached(path: str, device_ids: list, cache_dir: str, max_cache_bytes: int = 2 * 1024 ** 3):
+    """
+    the cached version of generate_poxyz_data_R.
+    The cache entry is keyed by the size, mtime and content hash of the raw file, and it holds all the tags of the
+    file, so a mission asking for other device ids can reuse it as well.
+
+    :param path: path of the raw pozyx file
+    :param device_ids: ids of the devices to return
+    :param cache_dir: folder of the cache, created if it does not exist
+    :param max_cache_bytes: size budget of cache_dir
+    :return: a dict of device id -> dict of memory-mapped column arrays
+    """
+    fingerprint = _get_file_fingerprint(path)
+    entry_path = os.path.join(cache_dir, fingerprint)
+
+    if os.path.isfile(os.path.join(entry_path, _INDEX_FILE)):
+        logging.info("pozyx cache hit for {}".format(path))
+        touch_entry(entry_path)
+    else:
+        logging.info("pozyx cache miss for {}, parsing the raw file".format(path))
+        a_dict, stats = parse_pozyx_log(path)
+        _write_entry(entry_path, path, a_dict, stats)
+        evict_entries(cache_dir, max_cache_bytes, keep=(fingerprint,), cache_name="pozyx cache")
+
+    a_dict, stats = _read_entry(entry_path, device_ids)
+    log_parse_stats(stats)
+    return a_dict
+
+
+###################################################################
+# code below may not be useful if you only want to apply the code #
+###################################################################
+
+def _get_file_fingerprint(path: str, chunk_size: int = 1024 * 1024):
+    """the key of a raw file, from its size, mtime and the hash of its content"""
+    file_stat = os.stat(path)
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            content_hash.update(chunk)
+    key = "{}:{}:{}".format(file_stat.st_size, file_stat.st_mtime_ns, content_hash.hexdigest())
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def _write_entry(entry_path: str, source_path: str, a_dict: dict, stats: dict):
+    """the entry is a folder with the columns of each tag and an index of the tags and the line statistics"""
+    def _write(temp_path):
+        os.makedirs(temp_path, exist_ok=True)
+        for tag_id, buffers in a_dict.items():
+            for a_column in _COLUMNS:
+                np.save(os.path.join(temp_path, "{}_{}.npy".format(tag_id, a_column)),
+                        np.asarray(buffers[a_column]))
+        with open(os.path.join(temp_path, _INDEX_FILE), "w") as f:
+            json.dump({"source": os.path.abspath(source_path), "tags": list(a_dict.keys()), "stats": stats}, f)
+    write_entry(entry_path, _write)
+
+
+def _read_entry(entry_path: str, device_ids: list):
+    """
+    :return: (dict of device id -> dict of column arrays, the line statistics of the raw file for these devices)
+    """
+    with open(os.path.join(entry_path, _INDEX_FILE)) as f:
+        index = json.load(f)
+
+    a_dict = {}
+    for device_id in device_ids:
+        if device_id in index["tags"]:
+            a_dict[device_id] = {a_column: np.load(os.path.join(entry_path, "{}_{}.npy".format(device_id, a_column)),
+                                                   mmap_mode="r")
+                                 for a_column in _COLUMNS}
+        else:
+            a_dict[device_id] = {a_column: np.array([], dtype=float) for a_column in _COLUMNS}
+
+    # the entry holds all the tags, the kept lines are counted again for the wanted ones like parse_pozyx_log does
+    stats = dict(index["stats"])
+    stats["kept"] = sum(len(a_dict[device_id]["timestamp"]) for device_id in set(device_ids))
+    stats["other_tags"] += index["stats"]["kept"] - stats["kept"]
+    return a_dict, stats
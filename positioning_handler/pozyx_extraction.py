@@ -3,7 +3,10 @@ Extracting pozyx data
 """
 
 import json
+import logging
 import math
+import re
+from array import array
 
 import numpy as np
 import pandas
@@ -25,50 +28,279 @@ def generate_single_file(output_path: str, pozyx_dict: dict, device_id, session_
     interpolation_result.to_csv(output_path)
 
 
-def generate_poxyz_data_R(path: str, device_ids: list):
-    a_dict = {}
+def generate_resampled_files(output_paths: list, pozyx_dict: dict, device_ids: list, session_name: str,
+                             rate: int = 1, circular_yaw: bool = False):
+    """
+    the batched version of generate_single_file.
+    All the devices are resampled together on one shared time grid, then each one is written to its output path.
+    :param output_paths: output paths, aligned with device_ids
+    :param pozyx_dict: the dict from generate_poxyz_data_R
+    :param device_ids: ids of the devices to resample
+    :param session_name: session name
+    :param rate: number of samples per second, like 1, 5 or 10
+    :param circular_yaw: interpolate the yaw along the shortest arc instead of linearly
+    """
+    resampled_dict = resample_pozyx_data(pozyx_dict, device_ids, rate=rate, circular_yaw=circular_yaw)
+    for output_path, device_id in zip(output_paths, device_ids):
+        a_df = resampled_dict[device_id]
+        a_df["session_name"] = session_name
+        a_df.to_csv(output_path)
+
+
+def resample_pozyx_data(pozyx_dict: dict, device_ids: list, rate: int = 1, circular_yaw: bool = False):
+    """
+    resample the raw positioning data of all the devices on one shared time grid with linear interpolation.
+    Each device only gets the grid points inside its own time range, the same as what interp1d allows.
 
+    The yaw is in radian and wraps around at 2 pi, so with circular_yaw the yaw is unwrapped before the
+    interpolation and wrapped back after it, which avoids the fake turns when a person faces around 0.
+
+    :param pozyx_dict: the dict from generate_poxyz_data_R
+    :param device_ids: ids of the devices to resample
+    :param rate: number of samples per second, like 1, 5 or 10
+    :param circular_yaw: interpolate the yaw along the shortest arc instead of linearly
+    :return: a dict of device id -> DataFrame with timestamp, x, y, yaw columns
+    """
+    tracks = {}
     for device_id in device_ids:
-        a_dict[device_id] = _gen_sub_dict()
-
-    jsons = _loading_json(path)
-    for line in jsons:
-        tag_id = int(line["tagId"])
-        if tag_id in device_ids:
-            if bool(line["success"]):
-                a_dict[tag_id]["timestamp"].append(line["timestamp"])
-                a_dict[tag_id]["success"].append(line["success"])
-                a_dict[tag_id]["x"].append(line["data"]["coordinates"]["x"])
-                a_dict[tag_id]["y"].append(line["data"]["coordinates"]["y"])
-                a_dict[tag_id]["yaw"].append(line["data"]["orientation"]["yaw"])
+        tracks[device_id] = _sorted_track(pozyx_dict[device_id])
 
+    grid = _get_time_grid([track[0] for track in tracks.values() if len(track[0]) != 0], rate)
+
+    result_dict = {}
+    for device_id in device_ids:
+        timestamp_array, pozyx_x, pozyx_y, pozyx_yaw = tracks[device_id]
+        if len(timestamp_array) == 0:
+            device_grid = grid[:0]
+        else:
+            device_grid = grid[np.searchsorted(grid, timestamp_array[0], side="left"):
+                               np.searchsorted(grid, timestamp_array[-1], side="right")]
+        x, y, yaw = _resample_track(timestamp_array, pozyx_x, pozyx_y, pozyx_yaw, device_grid, circular_yaw)
+        result_dict[device_id] = pandas.DataFrame({"timestamp": device_grid, "x": x, "y": y, "yaw": yaw})
+    return result_dict
+
+
+def generate_poxyz_data_R(path: str, device_ids: list):
+    a_dict, stats = parse_pozyx_log(path, device_ids)
+    log_parse_stats(stats)
     return a_dict
 
+
+def log_parse_stats(stats: dict):
+    """report the line statistics of parse_pozyx_log"""
+    logging.info("parsed {} pozyx lines, kept {}, skipped {} malformed and {} NOT_ALIVE".format(
+        stats["lines"], stats["kept"], stats["malformed"], stats["not_alive"]))
+
+
+def parse_pozyx_log(path: str, device_ids=None):
+    """
+    Streaming reader of the raw pozyx log.
+    The file is parsed line by line and only the fields used later (tagId, success, timestamp, x, y, yaw) are kept,
+    in typed array buffers per tag, so the memory follows the number of kept samples rather than the file size.
+
+    :param path: path of the raw pozyx file
+    :param device_ids: ids of the tags to keep, None for keeping every tag in the file
+    :return: (dict of tag id -> column buffers, dict of line statistics)
+    """
+    a_dict = {}
+    if device_ids is not None:
+        for device_id in device_ids:
+            a_dict[device_id] = _gen_sub_dict()
+
+    stats = _gen_stats_dict()
+    for tag_id, timestamp, x, y, yaw in _iter_pozyx_records(path, device_ids, stats):
+        if tag_id not in a_dict:
+            a_dict[tag_id] = _gen_sub_dict()
+        buffers = a_dict[tag_id]
+        buffers["timestamp"].append(timestamp)
+        buffers["success"].append(1)
+        buffers["x"].append(x)
+        buffers["y"].append(y)
+        buffers["yaw"].append(yaw)
+
+    return a_dict, stats
+
+
+class PozyxFollower(object):
+    """
+    Follow mode for a raw pozyx file which is still being written, like the log of a live session.
+    Each update only parses the lines appended since the last one and appends the new interpolated rows to the
+    output files, so the cost of an update does not grow with the length of the session.
+    The rows are the same as the ones of resample_pozyx_data on the whole file.
+    """
+
+    def __init__(self, path: str, device_ids: list, output_paths: list, session_name: str, rate: int = 1,
+                 circular_yaw: bool = False):
+        """
+        :param path: path of the raw pozyx file
+        :param device_ids: ids of the devices to follow
+        :param output_paths: output paths, aligned with device_ids
+        :param session_name: session name
+        :param rate: number of rows per second
+        :param circular_yaw: interpolate the yaw along the shortest arc instead of linearly
+        """
+        self.path = path
+        self.device_ids = list(device_ids)
+        self.output_paths = dict(zip(device_ids, output_paths))
+        self.session_name = session_name
+        self.rate = rate
+        self.circular_yaw = circular_yaw
+        # byte offset of the first line that is not parsed yet
+        self.offset = 0
+        self.stats = _gen_stats_dict()
+        self.rows_written = {device_id: 0 for device_id in device_ids}
+        # the last raw sample of each device (timestamp, x, y, yaw), the interpolation continues from it
+        self._last_sample = {device_id: None for device_id in device_ids}
+        # the index of the next grid point of each device, the grid point is index / rate
+        self._next_grid_index = {device_id: None for device_id in device_ids}
+
+    def update(self):
+        """
+        parse the complete lines appended since the last update, and append the new rows to the outputs
+        :return: a dict of device id -> number of new rows
+        """
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                appended = f.read()
+        except FileNotFoundError:
+            # the gateway has not created the file yet
+            return {device_id: 0 for device_id in self.device_ids}
+        # a line without its \n is still being written, it is left for the next update
+        end = appended.rfind(b"\n")
+        if end == -1:
+            return {device_id: 0 for device_id in self.device_ids}
+        self.offset += end + 1
+
+        a_dict = {device_id: _gen_sub_dict() for device_id in self.device_ids}
+        wanted = set(self.device_ids)
+        for line in appended[:end + 1].decode("utf-8", errors="replace").split("\n"):
+            a_record = _parse_pozyx_line(line, wanted, self.stats)
+            if a_record is not None:
+                buffers = a_dict[a_record[0]]
+                buffers["timestamp"].append(a_record[1])
+                buffers["x"].append(a_record[2])
+                buffers["y"].append(a_record[3])
+                buffers["yaw"].append(a_record[4])
+
+        new_rows = {}
+        for device_id in self.device_ids:
+            new_rows[device_id] = self._extend_device(device_id, a_dict[device_id])
+        return new_rows
+
+    def _extend_device(self, device_id, buffers: dict):
+        timestamp_array, pozyx_x, pozyx_y, pozyx_yaw = _sorted_track(buffers)
+        last_sample = self._last_sample[device_id]
+
+        if last_sample is not None:
+            # samples arriving later than the ones already used cannot be interpolated any more
+            is_new = timestamp_array > last_sample[0]
+            timestamp_array = np.concatenate(([last_sample[0]], timestamp_array[is_new]))
+            pozyx_x = np.concatenate(([last_sample[1]], pozyx_x[is_new]))
+            pozyx_y = np.concatenate(([last_sample[2]], pozyx_y[is_new]))
+            pozyx_yaw = np.concatenate(([last_sample[3]], pozyx_yaw[is_new]))
+        if len(timestamp_array) == 0:
+            return 0
+
+        if self.circular_yaw:
+            # the stored yaw is already unwrapped, so unwrapping continues from it
+            pozyx_yaw = np.unwrap(pozyx_yaw)
+        self._last_sample[device_id] = (timestamp_array[-1], pozyx_x[-1], pozyx_y[-1], pozyx_yaw[-1])
+
+        if self._next_grid_index[device_id] is None:
+            self._next_grid_index[device_id] = math.ceil(timestamp_array[0] * self.rate)
+        grid = np.arange(self._next_grid_index[device_id], math.floor(timestamp_array[-1] * self.rate) + 1)
+        if len(grid) == 0:
+            return 0
+        self._next_grid_index[device_id] = grid[-1] + 1
+        if self.rate != 1:
+            grid = grid / self.rate
+
+        x, y, yaw = _resample_track(timestamp_array, pozyx_x, pozyx_y, pozyx_yaw, grid, False)
+        if self.circular_yaw:
+            yaw = np.mod(yaw, 2 * math.pi)
+
+        rows_written = self.rows_written[device_id]
+        a_df = pandas.DataFrame({"timestamp": grid, "x": x, "y": y, "yaw": yaw},
+                                index=range(rows_written, rows_written + len(grid)))
+        a_df["session_name"] = self.session_name
+        a_df.to_csv(self.output_paths[device_id], mode="w" if rows_written == 0 else "a", header=rows_written == 0)
+        self.rows_written[device_id] += len(grid)
+        return len(grid)
+
+
 ###################################################################
 # code below may not be useful if you only want to apply the code #
 ###################################################################
 
+# used to find the tag of a line before decoding it, lines of unwanted tags are never decoded
+_TAG_ID_PATTERN = re.compile(r'"tagId"\s*:\s*"?(\d+)')
+
+
 def _gen_sub_dict():
     another_dict = {}
-    another_dict["timestamp"] = []
-    another_dict["success"] = []
-    another_dict["x"] = []
-    another_dict["y"] = []
-    another_dict["yaw"] = []
+    another_dict["timestamp"] = array("d")
+    another_dict["success"] = array("b")
+    another_dict["x"] = array("d")
+    another_dict["y"] = array("d")
+    another_dict["yaw"] = array("d")
     return another_dict
 
 
-def _loading_json(path: str):
-    json_list = []
+def _gen_stats_dict():
+    return {"lines": 0, "kept": 0, "malformed": 0, "not_alive": 0, "unsuccessful": 0, "other_tags": 0}
+
+
+def _iter_pozyx_records(path: str, device_ids, stats: dict):
+    """
+    generator over the successful records of the wanted tags in a raw pozyx file
+    :param path: path of the raw pozyx file
+    :param device_ids: ids of the tags to keep, None for all the tags
+    :param stats: the dict counting the lines, updated in place
+    :return: yields (tag id, timestamp, x, y, yaw)
+    """
+    wanted = None if device_ids is None else set(device_ids)
     with open(path, "r") as f:
-        lines = f.readlines()
-        for line in lines:
+        for line in f:
+            a_record = _parse_pozyx_line(line, wanted, stats)
+            if a_record is not None:
+                yield a_record
+
+
+def _parse_pozyx_line(line: str, wanted, stats: dict):
+    """parse a single line of the raw pozyx file, return None if the line should be skipped"""
+    # this len > 3 is to prevent the lines only contain a \n or something else
+    if len(line) <= 3:
+        return None
+    stats["lines"] += 1
+
+    if '"NOT_ALIVE"' in line:
+        stats["not_alive"] += 1
+        return None
+
+    match = _TAG_ID_PATTERN.search(line)
+    if match is None:
+        stats["malformed"] += 1
+        return None
+    tag_id = int(match.group(1))
+    if wanted is not None and tag_id not in wanted:
+        stats["other_tags"] += 1
+        return None
 
-            # this len > 3 is to prevent the lines only contain a \n or something else
-            if len(line) > 3:
-                string = line.strip()
-                json_list.append(json.loads(string[1:-1]))
-    return json_list
+    try:
+        record = json.loads(line.strip()[1:-1])
+        if not bool(record["success"]):
+            stats["unsuccessful"] += 1
+            return None
+        data = record["data"]
+        a_record = (tag_id, float(record["timestamp"]), float(data["coordinates"]["x"]),
+                    float(data["coordinates"]["y"]), float(data["orientation"]["yaw"]))
+    except (ValueError, KeyError, TypeError):
+        stats["malformed"] += 1
+        return None
+
+    stats["kept"] += 1
+    return a_record
 
 
 def _get_interpolated_data(data_frame):
@@ -97,3 +329,37 @@ def _get_interpolated_data(data_frame):
         "yaw": interpolate_yaw(timestamp_ints)
     })
     return interpolated_dataframe
+
+
+def _sorted_track(data_frame):
+    """the columns of a device as float arrays, sorted by timestamp"""
+    timestamp_array = np.asarray(data_frame["timestamp"], dtype=float)
+    order = np.argsort(timestamp_array, kind="stable")
+    return (timestamp_array[order], np.asarray(data_frame["x"], dtype=float)[order],
+            np.asarray(data_frame["y"], dtype=float)[order], np.asarray(data_frame["yaw"], dtype=float)[order])
+
+
+def _get_time_grid(timestamp_arrays: list, rate: int):
+    """the shared grid with rate points per second covering all the given timestamps"""
+    if len(timestamp_arrays) == 0:
+        return np.array([], dtype=int)
+    start = math.ceil(min(an_array[0] for an_array in timestamp_arrays) * rate)
+    end = math.floor(max(an_array[-1] for an_array in timestamp_arrays) * rate)
+    grid = np.arange(start, end + 1)
+    if rate == 1:
+        return grid
+    return grid / rate
+
+
+def _resample_track(timestamp_array, pozyx_x, pozyx_y, pozyx_yaw, grid, circular_yaw: bool):
+    """linear interpolation of a sorted track on the grid"""
+    if len(grid) == 0 or len(timestamp_array) == 0:
+        # a device without any successful sample has no rows
+        return np.array([], dtype=float), np.array([], dtype=float), np.array([], dtype=float)
+    x = np.interp(grid, timestamp_array, pozyx_x)
+    y = np.interp(grid, timestamp_array, pozyx_y)
+    if circular_yaw:
+        yaw = np.mod(np.interp(grid, timestamp_array, np.unwrap(pozyx_yaw)), 2 * math.pi)
+    else:
+        yaw = np.interp(grid, timestamp_array, pozyx_yaw)
+    return x, y, yaw
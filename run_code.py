@@ -5,13 +5,21 @@ This code file is the one you should run in the console to
 import json
 import sys
 import logging
+import time
 
+import numpy as np
 import pandas as pd
 
-from positioning_handler.f_formation import extract_formation
-from positioning_handler.feature_extraction import feature_extraction
+from positioning_handler.f_formation import extract_session_formation
+from positioning_handler.f_formation import summarize_sweep
+from positioning_handler.f_formation import sweep_formation
+from positioning_handler.feature_batch import batch_feature_extraction
+from positioning_handler.feature_batch import run_feature_mission
+from positioning_handler.formation_store import FormationStore
+from positioning_handler.pozyx_cache import load_pozyx_data_cached
+from positioning_handler.pozyx_extraction import PozyxFollower
 from positioning_handler.pozyx_extraction import generate_poxyz_data_R
-from positioning_handler.pozyx_extraction import generate_single_file
+from positioning_handler.pozyx_extraction import generate_resampled_files
 from webrtc_with_CMUSphinx.voice_activity_detection import vad_on_unlabelled_data, vad_on_unlabelled_data_segments
 
 
@@ -38,14 +46,30 @@ def _main(argv):
             logging.info("extracting f-formation data")
             _get_f_formation(a_misson)
 
+        elif a_misson["mission_type"] == "f_formation_sweep":
+            logging.info("sweeping f-formation thresholds")
+            _sweep_f_formation(a_misson)
+
+        elif a_misson["mission_type"] == "export_formation_store":
+            logging.info("exporting f-formation store to csv")
+            _export_formation_store(a_misson)
+
         elif a_misson["mission_type"] == "interpolate_pozyx":
             logging.info("extracting interpolated pozyx data")
             _interplolate_pozyx(a_misson)
 
+        elif a_misson["mission_type"] == "follow_pozyx":
+            logging.info("following a live pozyx file")
+            _follow_pozyx(a_misson)
+
         elif a_misson["mission_type"] == "feature_extraction":
             logging.info("doing feature extraction")
             _extract_features(a_misson)
 
+        elif a_misson["mission_type"] == "batch_feature_extraction":
+            logging.info("doing feature extraction of many sessions")
+            _batch_extract_features(a_misson)
+
         else:
             logging.warning("unexpected mission type, received '{}' in number {} mission (start from 0)".format(
                 a_misson["mission_type"], i))
@@ -62,6 +86,12 @@ def _do_vad(mission_json):
 
     word_threshold = int(mission_json["word_thres"])
     number_of_thread = int(mission_json["thread_number"])
+    number_of_process = int(mission_json.get("process_number", 0))
+    cache_dir = mission_json.get("cache_dir")
+    max_cache_bytes = int(float(mission_json.get("cache_size_mb", 256)) * 1024 * 1024)
+    prefix_seconds = mission_json.get("prefix_seconds")
+    if prefix_seconds is not None:
+        prefix_seconds = float(prefix_seconds)
 
     time_type = str(mission_json["time_format"])
 
@@ -74,11 +104,15 @@ def _do_vad(mission_json):
     if time_type == "hms" or time_type == "seconds":
         vad_on_unlabelled_data(audio_path=audio_path, output_path=output_path, session_name=session_name,
                                word_threshold=word_threshold, number_of_thread=number_of_thread,
-                               time_type=time_type)
+                               time_type=time_type, number_of_process=number_of_process,
+                               cache_dir=cache_dir, max_cache_bytes=max_cache_bytes,
+                               prefix_seconds=prefix_seconds)
     # output csv using segments format is the only one can be used in feature extraction
     elif time_type == "segments":
         vad_on_unlabelled_data_segments(audio_path=audio_path, output_path=output_path, session_name=session_name,
-                                        word_threshold=word_threshold, number_of_thread=number_of_thread)
+                                        word_threshold=word_threshold, number_of_thread=number_of_thread,
+                                        number_of_process=number_of_process, cache_dir=cache_dir,
+                                        max_cache_bytes=max_cache_bytes, prefix_seconds=prefix_seconds)
     else:
         logging.warning("unsupported time_type, only 'segments', 'seconds', and 'hms' are expected")
     return
@@ -87,45 +121,76 @@ def _do_vad(mission_json):
 def _get_f_formation(mission_json):
     interpolated_pozyx_path = mission_json["interpolated_pozyx_path"]
     pozyx_device_id = mission_json["pozyx_device_id"]
-    output_path = mission_json["output_path"]
+    # at least one of output_path and store_path should be given
+    output_path = mission_json.get("output_path")
+    store_path = mission_json.get("store_path")
     session_name = str(mission_json["session_name"])
 
     fov_thres = int(mission_json["fov_threshold"])
     distance_thres = int(mission_json["distance_threshold"])
     do_correction = bool(mission_json["correction"])
+    # optional, for rooms with many devices
+    spatial_index = bool(mission_json.get("spatial_index", 0))
     data_dict = {}
 
     # fetch all the dat into a dict, then pass to the function
     for i in range(len(interpolated_pozyx_path)):
         data_dict[pozyx_device_id[i]] = pd.read_csv(interpolated_pozyx_path[i])
 
-    for i in range(len(interpolated_pozyx_path)):
-        extract_formation(data_dict, pozyx_device_id, pozyx_device_id[i], output_path[i], session_name,
-                          fov_thres=fov_thres, distance_thres=distance_thres, do_correction=do_correction)
+    extract_session_formation(data_dict, pozyx_device_id, output_path, session_name,
+                              fov_thres=fov_thres, distance_thres=distance_thres, do_correction=do_correction,
+                              spatial_index=spatial_index, store_path=store_path)
 
 
-def _extract_features(mission_json):
+def _export_formation_store(mission_json):
+    formation_store = FormationStore(str(mission_json["store_path"]))
+    pozyx_device_id = mission_json["pozyx_device_id"]
+    output_path = mission_json["output_path"]
+
+    for i in range(len(pozyx_device_id)):
+        formation_store.to_legacy_csv(pozyx_device_id[i], output_path[i])
+
+
+def _sweep_f_formation(mission_json):
+    interpolated_pozyx_path = mission_json["interpolated_pozyx_path"]
     pozyx_device_id = mission_json["pozyx_device_id"]
-    audio_data_path = mission_json["audio_data_path"]
-    formation_path = mission_json["formation_path"]
-    feature_list = mission_json["feature"]
-    audio_start_timestamp = float(mission_json["audio_start_timestamp"])
-    session_name = str(mission_json["session_name"])
-    merging_threshold = float(mission_json["segment_merging_threshold"])
-    connected_threshold = float(mission_json["connected_threshold"])
     output_path = str(mission_json["output_path"])
-    # f-formation的文件就是talk to relation,
-    audio_data_dict = {}
-    formation_data_dict = {}
+    summary_path = str(mission_json["summary_path"])
 
-    for i, a_path in enumerate(audio_data_path):
-        audio_data_dict[pozyx_device_id[i]] = pd.read_csv(a_path)
-    for i, a_path in enumerate(formation_path):
-        formation_data_dict[pozyx_device_id[i]] = pd.read_csv(a_path)
+    fov_list = [int(a_value) for a_value in mission_json["fov_threshold"]]
+    distance_list = [int(a_value) for a_value in mission_json["distance_threshold"]]
+    correction_list = [bool(a_value) for a_value in mission_json.get("correction", [0, 1])]
+    data_dict = {}
 
-    feature_extraction(audio_data_dict, formation_data_dict, pozyx_device_id,
-                       audio_start_timestamp, connected_threshold, merging_threshold, feature_list,
-                       session_name, output_path)
+    for i in range(len(interpolated_pozyx_path)):
+        data_dict[pozyx_device_id[i]] = pd.read_csv(interpolated_pozyx_path[i])
+
+    sweep = sweep_formation(data_dict, pozyx_device_id, fov_list, distance_list, correction_list)
+    np.savez_compressed(output_path, **sweep)
+    summarize_sweep(sweep).to_csv(summary_path)
+
+
+def _extract_features(mission_json):
+    run_feature_mission(mission_json)
+
+
+def _batch_extract_features(mission_json):
+    output_path = str(mission_json["output_path"])
+    report_path = mission_json.get("report_path")
+    process_number = mission_json.get("process_number")
+    if "manifest" in mission_json:
+        with open(mission_json["manifest"]) as f:
+            session_list = json.load(f)
+    else:
+        session_list = mission_json["sessions"]
+    # the other items are shared by all the sessions
+    default_dict = {a_key: a_value for a_key, a_value in mission_json.items()
+                    if a_key not in ("mission_type", "output_path", "report_path", "process_number", "manifest",
+                                     "sessions")}
+
+    batch_feature_extraction(session_list, output_path, report_path,
+                             process_number=None if process_number is None else int(process_number),
+                             default_dict=default_dict)
 
 
 def _interplolate_pozyx(mission_json):
@@ -133,13 +198,45 @@ def _interplolate_pozyx(mission_json):
     pozyx_device_ids = mission_json["pozyx_device_id"]
     output_path = mission_json["output_path"]
     session_name = str(mission_json["session_name"])
+    # optional, the default is one row per second
+    rate = int(mission_json.get("rate", 1))
+    circular_yaw = bool(mission_json.get("circular_yaw", 0))
 
     # execution
 
-    pozyx_dict = generate_poxyz_data_R(pozyx_path, pozyx_device_ids)
+    if "cache_dir" in mission_json:
+        max_cache_bytes = int(float(mission_json.get("cache_size_mb", 2048)) * 1024 * 1024)
+        pozyx_dict = load_pozyx_data_cached(pozyx_path, pozyx_device_ids, str(mission_json["cache_dir"]),
+                                            max_cache_bytes=max_cache_bytes)
+    else:
+        pozyx_dict = generate_poxyz_data_R(pozyx_path, pozyx_device_ids)
+
+    generate_resampled_files(output_path, pozyx_dict, pozyx_device_ids, session_name,
+                             rate=rate, circular_yaw=circular_yaw)
+
 
-    for i in range(len(pozyx_device_ids)):
-        generate_single_file(output_path[i], pozyx_dict, pozyx_device_ids[i], session_name)
+def _follow_pozyx(mission_json):
+    pozyx_path = str(mission_json["pozyx_path"])
+    pozyx_device_ids = mission_json["pozyx_device_id"]
+    output_path = mission_json["output_path"]
+    session_name = str(mission_json["session_name"])
+    rate = int(mission_json.get("rate", 1))
+    circular_yaw = bool(mission_json.get("circular_yaw", 0))
+    # seconds between two reads of the file, and seconds without new lines before stopping
+    poll_interval = float(mission_json.get("poll_interval", 1))
+    idle_timeout = float(mission_json.get("idle_timeout", 60))
+
+    follower = PozyxFollower(pozyx_path, pozyx_device_ids, output_path, session_name,
+                             rate=rate, circular_yaw=circular_yaw)
+    last_change = time.time()
+    while time.time() - last_change < idle_timeout:
+        offset = follower.offset
+        new_rows = follower.update()
+        if follower.offset != offset:
+            last_change = time.time()
+            logging.info("appended rows {}".format(new_rows))
+        time.sleep(poll_interval)
+    logging.info("no new pozyx data in {} seconds, stop following".format(idle_timeout))
 
 
 if __name__ == '__main__':
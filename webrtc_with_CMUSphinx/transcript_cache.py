@@ -0,0 +1,68 @@
+"""
+On-disk cache of the transcriptions of the speech to text check.
+A transcription is keyed by the hash of the PCM data of the clip and the settings of the recognizer, so running
+the VAD again on the same audio, with another word threshold or time format, does not run the recognizer again.
+Each transcription is a small text file in the cache folder, which is handled by disk_cache like the other caches.
+"""
+
+import logging
+import os
+
+from positioning_handler.disk_cache import evict_entries, get_cache_key, touch_entry, write_entry
+
+
+def get_clip_key(clip_data: bytes, frame_rate: int, sample_width: int, channels: int, recognizer_config: str):
+    """the key of a clip, from its PCM data, its format and the settings of the recognizer"""
+    return get_cache_key("{}:{}:{}:{}".format(frame_rate, sample_width, channels, recognizer_config).encode(),
+                         clip_data)
+
+
+class TranscriptCache(object):
+    """
+    The transcriptions of clips in a cache folder.
+    hits and misses count the lookups since the cache was opened.
+    """
+
+    def __init__(self, cache_dir: str, max_cache_bytes: int = 256 * 1024 ** 2):
+        """
+        :param cache_dir: folder of the cache, created if it does not exist
+        :param max_cache_bytes: size budget of the folder, applied when the cache is closed
+        """
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_many(self, key_list: list):
+        """
+        :return: a list with the transcription of each key, None for the keys not in the cache
+        """
+        result_list = []
+        for a_key in key_list:
+            entry_path = self._get_entry_path(a_key)
+            try:
+                with open(entry_path, encoding="utf-8") as f:
+                    result_list.append(f.read())
+            except FileNotFoundError:
+                self.misses += 1
+                result_list.append(None)
+                continue
+            self.hits += 1
+            touch_entry(entry_path)
+        return result_list
+
+    def put_many(self, item_list: list):
+        """save a list of (key, transcription)"""
+        for a_key, a_transcript in item_list:
+            def _write(temp_path):
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(a_transcript)
+            write_entry(self._get_entry_path(a_key), _write)
+
+    def close(self):
+        logging.info("speech to text cache: {} hits, {} misses".format(self.hits, self.misses))
+        evict_entries(self.cache_dir, self.max_cache_bytes, cache_name="speech to text cache")
+
+    def _get_entry_path(self, a_key: str):
+        return os.path.join(self.cache_dir, "{}.txt".format(a_key))
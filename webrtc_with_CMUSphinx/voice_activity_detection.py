@@ -7,7 +7,9 @@ from webrtc_with_CMUSphinx import webRTC_with_speech2text
 
 
 def vad_on_unlabelled_data(audio_path: str, output_path: str, session_name: str, strictness_level: int = 3,
-                           word_threshold: int = 1, number_of_thread: int = 0, time_type: str = "timestamp"):
+                           word_threshold: int = 1, number_of_thread: int = 0, time_type: str = "timestamp",
+                           number_of_process: int = 0, cache_dir: str = None, max_cache_bytes: int = 256 * 1024 ** 2,
+                           prefix_seconds: float = None):
     """
     This function is doing the VAD on unlabelled audio data.
     It will generate a new csv file containing the "session", "audio time", "audio" columns
@@ -28,6 +30,16 @@ def vad_on_unlabelled_data(audio_path: str, output_path: str, session_name: str,
       Increasing this value may lead to the increasing of recall and decreasing of precision.
     :param number_of_thread: number of thread for accelerate the computing time. 1 for not using multi-threading
     :param time_type: the format of time in the time column
+    :param number_of_process: number of processes for the speech to text, used instead of number_of_thread when it
+     is more than 1. Unlike threads, processes make use of several cpus
+    :param cache_dir: folder keeping the transcriptions of the voiced segments. Running the VAD again on the same
+     audio, like with another word_threshold or time_type, then does not need the speech to text again
+    :param max_cache_bytes: size budget of cache_dir
+    :param prefix_seconds: if given, only the first prefix_seconds of a longer voiced segment are transcribed first,
+     and the segment is kept without transcribing the rest when they already have more words than word_threshold.
+     It saves most of the speech to text on long segments, but the check is then done on other audio, so a few
+     segments can be kept that the whole transcription would throw away (none with 2 seconds or more on the example
+     recordings). With word_threshold 0 nothing is transcribed at all, and the result is the same as without it
     :return: the result DataFrame
     """
     # the result dataframe contains three columns called
@@ -38,7 +50,11 @@ def vad_on_unlabelled_data(audio_path: str, output_path: str, session_name: str,
     result_string = webRTC_with_speech2text.do_vad_with_speech_to_text(audio_path,
                                                                        strictness_level=strictness_level,
                                                                        word_threshold=word_threshold,
-                                                                       number_of_thread=number_of_thread)
+                                                                       number_of_thread=number_of_thread,
+                                                                       number_of_process=number_of_process,
+                                                                       cache_dir=cache_dir,
+                                                                       max_cache_bytes=max_cache_bytes,
+                                                                       prefix_seconds=prefix_seconds)
 
     if not len(result_string) == 0:
         # decode the return of the result
@@ -61,7 +77,9 @@ def vad_on_unlabelled_data(audio_path: str, output_path: str, session_name: str,
 
 
 def vad_on_unlabelled_data_segments(audio_path: str, output_path: str, session_name: str, strictness_level: int = 3,
-                                    word_threshold: int = 1, number_of_thread: int = 0):
+                                    word_threshold: int = 1, number_of_thread: int = 0, number_of_process: int = 0,
+                                    cache_dir: str = None, max_cache_bytes: int = 256 * 1024 ** 2,
+                                    prefix_seconds: float = None):
     """
     almost the same with the upper one, with only some codes to create data in segment format, like (0.2, 1.2)
     csv contains columns ["session,	voice_start, voice_end"]
@@ -74,7 +92,11 @@ def vad_on_unlabelled_data_segments(audio_path: str, output_path: str, session_n
     result_string = webRTC_with_speech2text.do_vad_with_speech_to_text(audio_path,
                                                                        strictness_level=strictness_level,
                                                                        word_threshold=word_threshold,
-                                                                       number_of_thread=number_of_thread)
+                                                                       number_of_thread=number_of_thread,
+                                                                       number_of_process=number_of_process,
+                                                                       cache_dir=cache_dir,
+                                                                       max_cache_bytes=max_cache_bytes,
+                                                                       prefix_seconds=prefix_seconds)
     if not len(result_string) == 0:
         # decode the return of the result
         for a_segment in result_string.split("|"):
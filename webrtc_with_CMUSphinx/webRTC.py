@@ -48,6 +48,7 @@ def write_wave(path, audio, sample_rate):
 
 class Frame(object):
     """Represents a "frame" of audio data."""
+    __slots__ = ("bytes", "timestamp", "duration")
 
     def __init__(self, bytes, timestamp, duration):
         self.bytes = bytes
@@ -71,12 +72,188 @@ def frame_generator(frame_duration_ms, audio, sample_rate):
         offset += n
 
 
+def stream_wave(path, frame_duration_ms, chunk_duration_s=60.0):
+    """Reads a .wav file as a stream of frames.
+    Takes the path, the frame duration in milliseconds, and the seconds of audio
+    read at a time. Returns (generator of Frames, sample rate).
+    The frames are the same as frame_generator on the output of read_wave, but
+    only a chunk of the file is in memory at a time, and the bytes of a frame
+    are a memoryview on the chunk instead of a copy.
+    """
+    wf = wave.open(path, 'rb')
+    try:
+        num_channels = wf.getnchannels()
+        assert num_channels == 1
+        sample_width = wf.getsampwidth()
+        assert sample_width == 2
+        sample_rate = wf.getframerate()
+        assert sample_rate in (8000, 16000, 32000, 48000)
+    except AssertionError:
+        wf.close()
+        raise
+    return _stream_frames(wf, frame_duration_ms, sample_rate, chunk_duration_s), sample_rate
+
+
+def _stream_frames(wf, frame_duration_ms, sample_rate, chunk_duration_s):
+    n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+    timestamp = 0.0
+    duration = (float(n) / sample_rate) / 2.0
+    frames_per_chunk = max(1, int(chunk_duration_s * 1000 / frame_duration_ms))
+    with contextlib.closing(wf):
+        for frame_bytes in _stream_frame_bytes(wf, n, frames_per_chunk * n // 2):
+            yield Frame(frame_bytes, timestamp, duration)
+            timestamp += duration
+
+
+def _stream_frame_bytes(wf, n, samples_per_chunk):
+    """Yields the bytes of each frame of n bytes, except a last frame
+    ending exactly at the end of the file, like frame_generator does.
+    """
+    held = None  # the last whole frame, yielded once some audio follows it
+    partial = b""  # bytes of an incomplete frame at the end of the last chunk
+    while True:
+        data = wf.readframes(samples_per_chunk)
+        if not data:
+            return
+        if held is not None:
+            yield held
+            held = None
+        if partial:
+            data = partial + data
+        view = memoryview(data)
+        whole = len(view) - len(view) % n
+        for offset in range(0, whole - n, n):
+            yield view[offset:offset + n]
+        if whole == 0:
+            partial = bytes(view)
+        elif whole < len(view):
+            yield view[whole - n:whole]
+            partial = bytes(view[whole:])
+        else:
+            held = view[whole - n:whole]
+            partial = b""
+
+
 #############################
 # code above here is not meant to be used.
 #
 ################################
 
 
+class OnlineVad(object):
+    """VAD on audio arriving piece by piece, like from a socket or a live recording.
+
+    It keeps the trigger state of vad_collector between calls, with running
+    counts of the voiced and unvoiced frames in the ring buffer, and returns
+    the start and end of the voiced regions as soon as they are detected.
+    An event is ("start", frame index) or ("end", frame index), the time in
+    seconds is frame index * frame_duration_ms / 1000.
+    The regions are the same as vad_collector on the frames of the whole audio.
+    """
+
+    def __init__(self, vad, sample_rate, frame_duration_ms=30, padding_duration_ms=300):
+        """
+        vad - An instance of webrtcvad.Vad.
+        sample_rate - The audio sample rate, in Hz.
+        frame_duration_ms - The frame duration in milliseconds.
+        padding_duration_ms - The amount to pad the window, in milliseconds.
+        """
+        self.vad = vad
+        self.sample_rate = sample_rate
+        self.frame_duration_ms = frame_duration_ms
+        self.num_padding_frames = int(padding_duration_ms / frame_duration_ms)
+        self.frame_bytes = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        # the ring buffer only needs if each frame is speech
+        self.ring_buffer = collections.deque(maxlen=self.num_padding_frames)
+        self.num_voiced = 0
+        self.num_unvoiced = 0
+        # We have two states: TRIGGERED and NOTTRIGGERED. We start in the
+        # NOTTRIGGERED state.
+        self.triggered = False
+        self.frame_index = 0
+        self.num_voiced_frames = 0
+        # audio not processed yet, less than a frame, or a whole frame kept until some audio follows it
+        # because the last frame is dropped when it ends exactly at the end of the audio, like frame_generator
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """Takes PCM audio data of any length, returns the list of new events."""
+        self._buffer += chunk
+        event_list = []
+        offset = 0
+        with memoryview(self._buffer) as view:
+            while len(view) - offset > self.frame_bytes:
+                an_event = self.feed_frame(view[offset:offset + self.frame_bytes])
+                if an_event is not None:
+                    event_list.append(an_event)
+                offset += self.frame_bytes
+        del self._buffer[:offset]
+        return event_list
+
+    def flush(self):
+        """Ends the audio, returns the list of the last events."""
+        self._buffer = bytearray()
+        # If we have any leftover voiced audio when we run out of input, end the region.
+        if self.num_voiced_frames:
+            self.num_voiced_frames = 0
+            self.triggered = False
+            self.ring_buffer.clear()
+            self.num_voiced = self.num_unvoiced = 0
+            return [("end", self.frame_index)]
+        return []
+
+    def feed_frame(self, frame_bytes):
+        """Takes the PCM audio data of one frame, returns an event or None."""
+        is_speech = self.vad.is_speech(frame_bytes, self.sample_rate)
+        an_event = None
+
+        if self.ring_buffer.maxlen:
+            if len(self.ring_buffer) == self.ring_buffer.maxlen:
+                # the oldest frame leaves the ring buffer
+                if self.ring_buffer[0]:
+                    self.num_voiced -= 1
+                else:
+                    self.num_unvoiced -= 1
+            if is_speech:
+                self.num_voiced += 1
+            else:
+                self.num_unvoiced += 1
+        self.ring_buffer.append(is_speech)
+
+        if not self.triggered:
+            # If we're NOTTRIGGERED and more than 90% of the frames in
+            # the ring buffer are voiced frames, then enter the
+            # TRIGGERED state.
+            # here maxlen is 10,
+            # changed from > to >=
+            if self.num_voiced >= 0.9 * self.ring_buffer.maxlen:
+                self.triggered = True
+                an_event = ("start", self.frame_index - self.num_padding_frames)
+                # the frames already in the ring buffer are the start of the region
+                self.num_voiced_frames += len(self.ring_buffer)
+                self._clear_ring_buffer()
+        else:
+            # We're in the TRIGGERED state, so count the frame and check
+            # the ring buffer.
+            self.num_voiced_frames += 1
+            # If more than 90% of the frames in the ring buffer are
+            # unvoiced, then enter NOTTRIGGERED.
+            if self.num_unvoiced > 0.9 * self.ring_buffer.maxlen:
+                # this part is changed from i to i - num_padding_frames to remove the empty frames
+                an_event = ("end", self.frame_index - self.num_padding_frames)
+                self.triggered = False
+                self._clear_ring_buffer()
+                self.num_voiced_frames = 0
+
+        self.frame_index += 1
+        return an_event
+
+    def _clear_ring_buffer(self):
+        self.ring_buffer.clear()
+        self.num_voiced = 0
+        self.num_unvoiced = 0
+
+
 def vad_collector(sample_rate, frame_duration_ms,
                   padding_duration_ms, vad, frames):
     """Filters out non-voiced audio frames.
@@ -87,72 +264,21 @@ def vad_collector(sample_rate, frame_duration_ms,
     padding_duration_ms - The amount to pad the window, in milliseconds.
     vad - An instance of webrtcvad.Vad.
     frames - a source of audio frames (sequence or generator).
-    Returns: A generator that yields PCM audio data.
+    Returns: A list of [start frame index, end frame index] of the voiced regions.
     """
-    num_padding_frames = int(padding_duration_ms / frame_duration_ms)
-    # We use a deque for our sliding window/ring buffer.
-    #
-    ring_buffer = collections.deque(maxlen=num_padding_frames)
-    # We have two states: TRIGGERED and NOTTRIGGERED. We start in the
-    # NOTTRIGGERED state.
-    triggered = False
-    i = 0
+    online_vad = OnlineVad(vad, sample_rate, frame_duration_ms, padding_duration_ms)
     voiced_frames_id = []
     voiced_region_list = []
-    voiced_frames = []
     for frame in frames:
-        is_speech = vad.is_speech(frame.bytes, sample_rate)
-
-        # sys.stdout.write('1' if is_speech else '0')
-        if not triggered:
-            ring_buffer.append((frame, is_speech))
-            num_voiced = len([f for f, speech in ring_buffer if speech])
-            # If we're NOTTRIGGERED and more than 90% of the frames in
-            # the ring buffer are voiced frames, then enter the
-            # TRIGGERED state.
-
-            # here maxlen is 10,
-            # changed from > to >=
-            if num_voiced >= 0.9 * ring_buffer.maxlen:  # when num voice is enough, go into trigger, start counting as voiced
-                triggered = True
-                voiced_frames_id.append(i - num_padding_frames)
-                # sys.stdout.write('+(%s)' % (ring_buffer[0][0].timestamp,))
-                # We want to yield all the audio we see from now until
-                # we are NOTTRIGGERED, but we have to start with the
-                # audio that's already in the ring buffer.
-                for f, s in ring_buffer:
-                    voiced_frames.append(f)
-                ring_buffer.clear()
-        else:
-            # We're in the TRIGGERED state, so collect the audio data
-            # and add it to the ring buffer.           voiced frame will record little frames after being triggered
-            voiced_frames.append(frame)
-            ring_buffer.append((frame, is_speech))
-            num_unvoiced = len([f for f, speech in ring_buffer if not speech])
-            # If more than 90% of the frames in the ring buffer are
-            # unvoiced, then enter NOTTRIGGERED and yield whatever
-            # audio we've collected.
-            # changed to >=? No
-            if num_unvoiced > 0.9 * ring_buffer.maxlen:
-                # sys.stdout.write('-(%s)' % (frame.timestamp + frame.duration))
-                # this part is changed from i to i - num_padding_frames to remove the empty frames
-                voiced_frames_id.append(i - num_padding_frames)
+        an_event = online_vad.feed_frame(frame.bytes)
+        if an_event is not None:
+            voiced_frames_id.append(an_event[1])
+            if an_event[0] == "end":
                 voiced_region_list.append(voiced_frames_id)
-                triggered = False
-                ring_buffer.clear()
-                voiced_frames = []
                 voiced_frames_id = []
 
-        i += 1
-
-    # if triggered:
-    # sys.stdout.write('-(%s)' % (frame.timestamp + frame.duration))
-    # sys.stdout.write('\n')
-    # If we have any leftover voiced audio when we run out of input,
-    # yield it.
-    if voiced_frames:
-        voiced_frames_id.append(i)
+    for an_event in online_vad.flush():
+        voiced_frames_id.append(an_event[1])
         voiced_region_list.append(voiced_frames_id)
         voiced_frames_id = []
     return voiced_region_list
-
@@ -2,9 +2,15 @@
 This part of code combines the webrtcvad with Sphinx
 """
 
+import importlib.metadata
+import logging
 import math
 import os
+import queue
 import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 
 import pydub
 import speech_recognition as sr
@@ -12,32 +18,35 @@ import webrtcvad
 from tqdm.auto import tqdm
 
 from webrtc_with_CMUSphinx import webRTC
+from webrtc_with_CMUSphinx.transcript_cache import TranscriptCache, get_clip_key
 
-##########################################
-temp_file_path = "temporay_files"
 
-
-########################################
-
-def do_vad_with_speech_to_text(path: str, strictness_level: int, word_threshold: int = 1, number_of_thread: int = 0):
+def do_vad_with_speech_to_text(path: str, strictness_level: int, word_threshold: int = 1, number_of_thread: int = 0,
+                               number_of_process: int = 0, cache_dir: str = None,
+                               max_cache_bytes: int = 256 * 1024 ** 2, prefix_seconds: float = None):
     """
     generate time segment (start time, end time), of voice segments, with the help of CMU Sphinx
     :param path: the path to the audio file for VAD
     :param strictness_level:
     :param word_threshold:
     :param number_of_thread: 0 or 1 for not using multi-threading
+    :param number_of_process: more than 1 to do the speech to text on this number of processes,
+     it is used instead of number_of_thread
+    :param cache_dir: folder keeping the transcriptions of the segments, so a new run on the same audio does not
+     recognize them again
+    :param max_cache_bytes: size budget of the cache
+    :param prefix_seconds: if given, a segment longer than it is kept as soon as its first prefix_seconds pass the
+     word_threshold, without recognizing the rest of it
 
     :return: str or list, depending on return_str
     """
-    audio, sample_rate = webRTC.read_wave(path)
-
     # Here is using the webRTC VAD to detect the voice segments
     # It is the first step
     vad = webrtcvad.Vad(strictness_level)
     segment_window = 30  #
 
-    frames = webRTC.frame_generator(segment_window, audio, sample_rate)
-    frames = list(frames)
+    # the frames are read from the file while the VAD goes through them, so the memory does not grow with the audio
+    frames, sample_rate = webRTC.stream_wave(path, segment_window)
     segments = webRTC.vad_collector(sample_rate, segment_window, 300, vad, frames)
 
     for content in segments:
@@ -48,7 +57,9 @@ def do_vad_with_speech_to_text(path: str, strictness_level: int, word_threshold:
     # Start from here, adding the _correction function with t2s toolkit
     # It will remove the segments that do not have transcription, which means it just a false positive of webRTC VAD
     segments = _do_speech_to_text_on_segments(segments, path, word_threshold=word_threshold,
-                                              number_of_thread=number_of_thread)
+                                              number_of_thread=number_of_thread, number_of_process=number_of_process,
+                                              cache_dir=cache_dir, max_cache_bytes=max_cache_bytes,
+                                              prefix_seconds=prefix_seconds)
 
     # # this one is to left a temporary json file to prevent error in later code
     # with open("path/temp.json", "w") as fp:
@@ -71,52 +82,48 @@ def do_vad_with_speech_to_text(path: str, strictness_level: int, word_threshold:
 ###################################################################
 
 class _Speech_to_text_thread(threading.Thread):
-    def __init__(self, threadID, name, audio_dub: pydub.AudioSegment, segment_list: list, output_list: list,
-                 word_threshold: int):
+    """
+    a worker taking the segments one by one from a shared queue until it is empty,
+    so a worker with long segments does not hold up the others
+    """
+
+    def __init__(self, threadID, name, audio_dub: pydub.AudioSegment, task_queue: queue.Queue, output_list: list,
+                 pbar):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
         self.audio_dub = audio_dub
-        self.segment_list = segment_list
-        self.word_threshold = word_threshold
+        self.task_queue = task_queue
         self.output_list = output_list
+        self.pbar = pbar
+        self.stats = {"worker": name, "segments": 0, "audio_seconds": 0.0, "busy_seconds": 0.0}
 
     def run(self):
         print("thread_started: " + self.name)
-        self.speech_to_text_threaded(self.segment_list, self.audio_dub, self.output_list, self.word_threshold)
+        while True:
+            try:
+                index, line = self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+            busy_start = time.perf_counter()
+            self.output_list[index] = self.speech_to_text_threaded(line, self.audio_dub)
+            self.stats["segments"] += 1
+            self.stats["audio_seconds"] += float(line[1]) - float(line[0])
+            self.stats["busy_seconds"] += time.perf_counter() - busy_start
+            self.pbar.update(1)
         print("thread_finished: " + self.name)
 
-    def speech_to_text_threaded(self, segments: list, audio_dub: pydub.AudioSegment, output_list: list, word_threshold: int):
-        with tqdm(total=len(segments)) as pbar:
-            for line in segments:
-                start = int(float(line[0]) * 1000)
-                end = int(float(line[1]) * 1000)
-
-                if end - start < 0.5:
-                    pbar.update(1)
-                    continue
-
-                clip = audio_dub[start: end]
-                clip.export(os.path.join(temp_file_path, "{}_{}.wav".format(start, end)), "wav")
-                clip_path = os.path.join(temp_file_path, "{}_{}.wav".format(start, end))
-                result = _speech2text_CMU(clip_path)
-                try:
-                    os.remove(clip_path)
-                except:
-                    print("====================\n" + "error on removing temporary files" + "========\n")
-                # 这个实际是有str就行，应该用split来确定有几个单词
-                # if len(result) > 2:
-                #     cleaned_segments.append(line)
-
-                # this one
-                if len(result.split(" ")) > word_threshold:
-                    output_list.append(line)
-                else:
-                    output_list.append("")
-                pbar.update(1)
-
-
-def _speech_to_text(segments: list, audio_dub: pydub.AudioSegment, output_list: list, word_threshold: int):
+    def speech_to_text_threaded(self, line, audio_dub: pydub.AudioSegment):
+        """the transcription of the segment, None for an empty segment"""
+        if _is_empty_segment(line):
+            return None
+
+        clip = audio_dub[int(float(line[0]) * 1000): int(float(line[1]) * 1000)]
+        return _speech2text_CMU_clip(clip)
+
+
+def _speech_to_text(segments: list, audio_dub: pydub.AudioSegment, output_list: list):
+    """add the transcription of each segment to output_list"""
     with tqdm(total=len(segments)) as pbar:
         for line in segments:
             start = int(float(line[0]) * 1000)
@@ -127,91 +134,264 @@ def _speech_to_text(segments: list, audio_dub: pydub.AudioSegment, output_list:
             #     continue
 
             clip = audio_dub[start: end]
-            clip.export(os.path.join(temp_file_path, "{}_{}.wav".format(start, end)), "wav")
-            clip_path = os.path.join(temp_file_path, "{}_{}.wav".format(start, end))
-            result = _speech2text_CMU(clip_path)
-            try:
-                os.remove(clip_path)
-            except:
-                print("====================\n" + "error on removing temporary files" + "========\n")
-            # 这个实际是有str就行，应该用split来确定有几个单词
-            # if len(result) > 2:
-            #     cleaned_segments.append(line)
-
-            # this one
-            if len(result.split(" ")) > word_threshold:
-                output_list.append(line)
+            output_list.append(_speech2text_CMU_clip(clip))
             pbar.update(1)
 
 
-def _split_list(original_list: list, split_to: int):
-    return [original_list[i: i + math.ceil(len(original_list) / split_to)] for i in
-            range(0, len(original_list), math.ceil(len(original_list) / split_to))]
+def _speech_to_text_threads(segments: list, audio_dub: pydub.AudioSegment, number_of_thread: int,
+                            worker_stats: list = None):
+    """the transcription of each segment, with the longest segments given to the threads first"""
+    # the result of each segment is saved at the index of the segment, so the order is kept
+    output_list = [None for _ in segments]
+    task_queue = queue.Queue()
+    for index in _get_longest_first_order(segments):
+        task_queue.put((index, segments[index]))
+
+    wall_start = time.perf_counter()
+    threads_list = []
+    with tqdm(total=len(segments)) as pbar:
+        for index in range(number_of_thread):
+            a_thread = _Speech_to_text_thread(index, "speech2text thread {}".format(index), audio_dub, task_queue,
+                                              output_list, pbar)
+            a_thread.start()
+            threads_list.append(a_thread)
+
+        for thread in threads_list:
+            thread.join()
+    _report_worker_stats([a_thread.stats for a_thread in threads_list], time.perf_counter() - wall_start,
+                         worker_stats)
+    return output_list
+
+
+def _speech_to_text_processes(segments: list, audio_dub: pydub.AudioSegment, number_of_process: int,
+                              worker_stats: list = None):
+    """
+    the transcription of each segment, like _speech_to_text, with the segments spread over a pool of processes.
+    The audio is put in shared memory once, and each process sets up its decoder once, when it starts.
+    The longest segments are sent first, and a process takes a new segment when it is done with one.
+    """
+    audio_data = audio_dub.raw_data
+    shared_audio = shared_memory.SharedMemory(create=True, size=max(len(audio_data), 1))
+    result_list = ["" for _ in segments]
+    stats_dict = {}
+    try:
+        shared_audio.buf[:len(audio_data)] = audio_data
+        initargs = (shared_audio.name, len(audio_data), audio_dub.frame_rate, audio_dub.sample_width,
+                    audio_dub.channels)
+        wall_start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=number_of_process, initializer=_init_speech_to_text_process,
+                                 initargs=initargs) as executor:
+            future_dict = {}
+            for index in _get_longest_first_order(segments):
+                clip_range = (int(float(segments[index][0]) * 1000), int(float(segments[index][1]) * 1000))
+                future_dict[executor.submit(_speech_to_text_process, clip_range)] = index
+
+            for a_future in tqdm(as_completed(future_dict), total=len(future_dict)):
+                index = future_dict[a_future]
+                result_list[index], process_id, busy_seconds = a_future.result()
+                if process_id not in stats_dict:
+                    stats_dict[process_id] = {"worker": "speech2text process {}".format(process_id), "segments": 0,
+                                              "audio_seconds": 0.0, "busy_seconds": 0.0}
+                stats_dict[process_id]["segments"] += 1
+                stats_dict[process_id]["audio_seconds"] += float(segments[index][1]) - float(segments[index][0])
+                stats_dict[process_id]["busy_seconds"] += busy_seconds
+        _report_worker_stats(list(stats_dict.values()), time.perf_counter() - wall_start, worker_stats)
+    finally:
+        shared_audio.close()
+        shared_audio.unlink()
+
+    return result_list
+
+
+def _get_clip_key_list(segments: list, audio_dub: pydub.AudioSegment):
+    """the key of the clip of each segment in the transcript cache"""
+    recognizer_config = _get_recognizer_config()
+    key_list = []
+    with memoryview(audio_dub.raw_data) as audio_data:
+        for line in segments:
+            clip_data = _get_clip_data(audio_data, int(float(line[0]) * 1000), int(float(line[1]) * 1000),
+                                       audio_dub.frame_rate, audio_dub.sample_width, audio_dub.channels)
+            key_list.append(get_clip_key(clip_data, audio_dub.frame_rate, audio_dub.sample_width, audio_dub.channels,
+                                         recognizer_config))
+    return key_list
+
+
+def _get_recognizer_config():
+    """the settings the transcriptions depend on, another version of the recognizer may give other ones"""
+    try:
+        pocketsphinx_version = importlib.metadata.version("pocketsphinx")
+    except importlib.metadata.PackageNotFoundError:
+        pocketsphinx_version = None
+    return "sphinx en-US, SpeechRecognition {}, pocketsphinx {}".format(sr.__version__, pocketsphinx_version)
+
+
+def _get_longest_first_order(segments: list):
+    """the indexes of the segments, from the longest segment to the shortest one"""
+    return sorted(range(len(segments)), key=lambda index: float(segments[index][0]) - float(segments[index][1]))
+
+
+def _report_worker_stats(stats_list: list, wall_seconds: float, worker_stats: list = None):
+    for a_stats in stats_list:
+        a_stats["utilisation"] = a_stats["busy_seconds"] / wall_seconds if wall_seconds > 0 else 0.0
+        logging.info("{worker}: {segments} segments, {audio_seconds:.1f} s of audio in {busy_seconds:.1f} s, "
+                     "busy {utilisation:.0%} of the time".format(**a_stats))
+    logging.info("speech to text took {:.1f} s".format(wall_seconds))
+    if worker_stats is not None:
+        worker_stats.extend(stats_list)
+
+
+# the state of a speech to text process, set by _init_speech_to_text_process
+_process_state = {}
 
 
-def _split_list_evenly(original_list: list, split_to: int):
-    splitted_list = [[] for _ in range(split_to)]
-    for index, item in enumerate(original_list):
-        splitted_list[index % split_to].append(item)
-    return splitted_list
+def _init_speech_to_text_process(shared_memory_name: str, audio_length: int, frame_rate: int, sample_width: int,
+                                 channels: int):
+    shared_audio = shared_memory.SharedMemory(name=shared_memory_name)
+    _process_state["shared_audio"] = shared_audio
+    _process_state["audio"] = shared_audio.buf[:audio_length]
+    _process_state["frame_rate"] = frame_rate
+    _process_state["sample_width"] = sample_width
+    _process_state["channels"] = channels
+    _process_state["decoder"] = _SphinxDecoder()
 
 
-def _assemble_splitted(spliited_list):
-    assmbled_list = []
-    len_list = len(spliited_list)
-    total_length = 0
-    for a_list in spliited_list:
-        total_length += len(a_list)
-    for index in range(total_length):
-        assmbled_list.append(spliited_list[index % len_list][int(index / len_list)])
-    return assmbled_list
+def _speech_to_text_process(clip_range: tuple):
+    """
+    the transcription of a clip, from start to end in milliseconds, in a speech to text process
+    :return: the transcription, the id of the process, and the seconds spent
+    """
+    busy_start = time.perf_counter()
+    clip_data = _get_clip_data(_process_state["audio"], clip_range[0], clip_range[1], _process_state["frame_rate"],
+                               _process_state["sample_width"], _process_state["channels"])
+    result = _process_state["decoder"].transcribe(
+        sr.AudioData(clip_data, _process_state["frame_rate"], _process_state["sample_width"]))
+    return result, os.getpid(), time.perf_counter() - busy_start
+
+
+def _get_clip_data(audio_data, start: int, end: int, frame_rate: int, sample_width: int, channels: int):
+    """the PCM data of audio_dub[start: end] with pydub, start and end in milliseconds, from a buffer"""
+    frame_width = sample_width * channels
+    length = round(1000 * (float(len(audio_data) // frame_width) / frame_rate))
+    start = min(start, length)
+    end = min(end, length)
+
+    positions = []
+    for a_position in (start, end):
+        if a_position < 0:
+            a_position = length - abs(a_position)
+        positions.append(int(a_position * (frame_rate / 1000.0)) * frame_width)
+    clip_data = bytes(audio_data[positions[0]:positions[1]])
+
+    # pydub fills up to 2 ms missing at the end of the audio with silence
+    missing_frames = (positions[1] - positions[0] - len(clip_data)) // frame_width
+    if missing_frames:
+        if missing_frames > 2 * (frame_rate / 1000.0):
+            raise pydub.exceptions.TooManyMissingFrames(
+                "You should never be filling in more than 2 ms with silence here, missing frames: %s" % missing_frames)
+        clip_data += bytes(len(clip_data[:frame_width])) * missing_frames
+    return clip_data
+
+
+class _SphinxDecoder(object):
+    """
+    A pocketsphinx decoder set up like Recognizer.recognize_sphinx with the default en-US model, loaded once
+    and used for many clips. The cepstral mean is set back before each clip, so a clip is decoded as by a new decoder.
+    If the installed pocketsphinx cannot do that, each clip goes through recognize_sphinx.
+    """
+
+    def __init__(self):
+        self.recognizer = sr.Recognizer()
+        self.decoder = None
+        self.initial_cmn = None
+        try:
+            from pocketsphinx import pocketsphinx
+        except ImportError:
+            # recognize_sphinx will raise the error of a missing pocketsphinx
+            return
+
+        language_directory = os.path.join(os.path.dirname(os.path.realpath(sr.__file__)), "pocketsphinx-data", "en-US")
+        if hasattr(pocketsphinx, "Config"):
+            config = pocketsphinx.Config()
+        else:
+            config = pocketsphinx.Decoder.default_config()
+        config.set_string("-hmm", os.path.join(language_directory, "acoustic-model"))
+        config.set_string("-lm", os.path.join(language_directory, "language-model.lm.bin"))
+        config.set_string("-dict", os.path.join(language_directory, "pronounciation-dictionary.dict"))
+        config.set_string("-logfn", os.devnull)
+        decoder = pocketsphinx.Decoder(config)
+        if hasattr(decoder, "get_cmn") and hasattr(decoder, "set_cmn"):
+            self.decoder = decoder
+            self.initial_cmn = decoder.get_cmn()
+        else:
+            logging.warning("this pocketsphinx cannot reset the decoder between clips, using recognize_sphinx")
+
+    def transcribe(self, audio: sr.AudioData):
+        """the transcription of the audio, "" if nothing is recognized"""
+        if self.decoder is None:
+            try:
+                return self.recognizer.recognize_sphinx(audio)
+            except sr.UnknownValueError:
+                return ""
+
+        # the included language models require audio to be 16-bit mono 16 kHz
+        raw_data = audio.get_raw_data(convert_rate=16000, convert_width=2)
+        self.decoder.set_cmn(self.initial_cmn)
+        self.decoder.start_utt()
+        self.decoder.process_raw(raw_data, False, True)
+        self.decoder.end_utt()
+        hypothesis = self.decoder.hyp()
+        if hypothesis is None:
+            return ""
+        return hypothesis.hypstr
+
+
+def _split_list(original_list: list, split_to: int):
+    return [original_list[i: i + math.ceil(len(original_list) / split_to)] for i in
+            range(0, len(original_list), math.ceil(len(original_list) / split_to))]
 
 
-def _do_speech_to_text_on_segments(segments: list, audio_path: str, word_threshold: int = 1, number_of_thread: int = 0):
+def _do_speech_to_text_on_segments(segments: list, audio_path: str, word_threshold: int = 1, number_of_thread: int = 0,
+                                   number_of_process: int = 0, worker_stats: list = None, cache_dir: str = None,
+                                   max_cache_bytes: int = 256 * 1024 ** 2, prefix_seconds: float = None,
+                                   early_exit_stats: dict = None):
     """
     code that actually used the
     :param segments:
     :param audio_path:
     :param word_threshold:
+    :param number_of_process: more than 1 to use processes instead of threads
+    :param worker_stats: if given, a dict for each thread or process is added to it, with the number of segments,
+     the seconds of audio and the seconds spent on them, and the share of the run time it was busy ("utilisation")
+    :param cache_dir: if given, the transcriptions are kept in this folder, and the segments already in it are not
+     recognized again
+    :param max_cache_bytes: size budget of the cache
+    :param prefix_seconds: if given, only the first prefix_seconds of a longer segment are recognized first, and the
+     whole segment is recognized only when the beginning does not have more than word_threshold words
+    :param early_exit_stats: if given, it is filled with the seconds of audio of the segments, and with
+     prefix_seconds the seconds of audio recognized, read from the cache, and skipped by the early exit
     :return:
     """
-    cleaned_segments = []
-
-    # create the temporary folder for saving the temporary files.
-    # It can be improved after rewrite the code of speechrecognition interface
-    if not os.path.exists(temp_file_path):
-        os.mkdir(temp_file_path)
-
+    if prefix_seconds is not None and prefix_seconds <= 0:
+        raise ValueError("prefix_seconds should be positive, received {}".format(prefix_seconds))
     # load the original audio file, for clipping
     audio_file = pydub.AudioSegment.from_file(audio_path, "wav")
-    if number_of_thread == 1 or number_of_thread == 0:
-        _speech_to_text(segments, audio_file, cleaned_segments, word_threshold)
+    cache = None if cache_dir is None else TranscriptCache(cache_dir, max_cache_bytes)
+
+    if prefix_seconds is None:
+        transcript_list = _get_transcript_list(segments, audio_file, number_of_thread, number_of_process,
+                                               worker_stats, cache)
+        # 这个实际是有str就行，应该用split来确定有几个单词
+        # if len(result) > 2:
+        #     cleaned_segments.append(line)
+        # this one
+        cleaned_segments = [line for line, a_transcript in zip(segments, transcript_list)
+                            if _has_enough_words(a_transcript, word_threshold)]
     else:
-        output_list = []
-        for _ in range(number_of_thread):
-            output_list.append([])
-        splitted_segments = _split_list_evenly(original_list=segments, split_to=number_of_thread)
-
-        threads_list = []
-        for index, sub_list in enumerate(splitted_segments):
-            a_thread = _Speech_to_text_thread(index, "speech2text thread {}".format(index), audio_file, sub_list,
-                                              output_list[index], word_threshold)
-            a_thread.start()
-            threads_list.append(a_thread)
-
-        for thread in threads_list:
-            thread.join()
-        output_segments = _assemble_splitted(output_list)
-
-        # the function used in the threading class is different
-        # it does not simply ignore the segments with short transcription
-        # it would add an empty string "" as placeholder due to the assemble algorithm
-        # here we do the clean up for the ""
-        cleaned_segments = []
-        for a_line in output_segments:
-            if a_line != "":
-                cleaned_segments.append(a_line)
-
+        cleaned_segments = _speech_to_text_early_exit(segments, audio_file, word_threshold, number_of_thread,
+                                                      number_of_process, worker_stats, cache, prefix_seconds,
+                                                      early_exit_stats)
+    if cache is not None:
+        cache.close()
 
     # try:
     #     for file in os.listdir(temp_file_path):
@@ -222,6 +402,106 @@ def _do_speech_to_text_on_segments(segments: list, audio_path: str, word_thresho
     return cleaned_segments
 
 
+def _has_enough_words(transcript, word_threshold: int):
+    """None is an empty segment skipped by the threads. Note that "".split(" ") has one item"""
+    return transcript is not None and len(transcript.split(" ")) > word_threshold
+
+
+def _get_transcript_list(segments: list, audio_file: pydub.AudioSegment, number_of_thread: int,
+                         number_of_process: int, worker_stats: list = None, cache: TranscriptCache = None,
+                         recognized_index_list: list = None):
+    """
+    the transcription of each segment, from the cache when it is there
+    :param recognized_index_list: if given, the indexes of the segments that were not in the cache are added to it
+    """
+    transcript_list = [None for _ in segments]
+    todo_index_list = list(range(len(segments)))
+    if cache is not None:
+        key_list = _get_clip_key_list(segments, audio_file)
+        transcript_list = cache.get_many(key_list)
+        todo_index_list = [index for index, a_transcript in enumerate(transcript_list) if a_transcript is None]
+    todo_segments = [segments[index] for index in todo_index_list]
+    if recognized_index_list is not None:
+        recognized_index_list.extend(todo_index_list)
+
+    if number_of_process > 1:
+        todo_transcript_list = _speech_to_text_processes(todo_segments, audio_file, number_of_process, worker_stats)
+    elif number_of_thread == 1 or number_of_thread == 0:
+        todo_transcript_list = []
+        _speech_to_text(todo_segments, audio_file, todo_transcript_list)
+    else:
+        # the threads skip the empty segments, their transcription is None
+        todo_transcript_list = _speech_to_text_threads(todo_segments, audio_file, number_of_thread, worker_stats)
+
+    for index, a_transcript in zip(todo_index_list, todo_transcript_list):
+        transcript_list[index] = a_transcript
+    if cache is not None:
+        cache.put_many([(key_list[index], a_transcript) for index, a_transcript
+                        in zip(todo_index_list, todo_transcript_list) if a_transcript is not None])
+    return transcript_list
+
+
+def _speech_to_text_early_exit(segments: list, audio_file: pydub.AudioSegment, word_threshold: int,
+                               number_of_thread: int, number_of_process: int, worker_stats: list,
+                               cache: TranscriptCache, prefix_seconds: float, early_exit_stats: dict = None):
+    """
+    the segments with more than word_threshold words, recognizing as little audio as possible.
+    With a word_threshold below 1, any transcription passes, so nothing is recognized and the result is exactly the
+    one of the whole transcriptions.
+    Otherwise, the segments longer than prefix_seconds are kept if their beginning has enough words, the others are
+    recognized as a whole. Sphinx can find more words in the beginning of a segment than in the whole segment, so
+    a few segments can be kept here that the whole transcription would drop, see the README for how many.
+    """
+    is_thread_mode = number_of_process <= 1 and number_of_thread > 1
+    segment_seconds = [float(line[1]) - float(line[0]) for line in segments]
+    is_kept_list = [None for _ in segments]
+    recognized_seconds = 0.0
+    cached_seconds = 0.0
+    skipped_seconds = 0.0
+
+    if word_threshold < 1:
+        for index, line in enumerate(segments):
+            # only the threads skip the empty segments
+            is_kept_list[index] = not (is_thread_mode and _is_empty_segment(line))
+        skipped_seconds = sum(segment_seconds)
+    else:
+        prefix_index_list = [index for index, a_length in enumerate(segment_seconds) if a_length > prefix_seconds]
+        prefix_segments = [[segments[index][0], float(segments[index][0]) + prefix_seconds]
+                           for index in prefix_index_list]
+        recognized_index_list = []
+        prefix_transcript_list = _get_transcript_list(prefix_segments, audio_file, number_of_thread,
+                                                      number_of_process, worker_stats, cache, recognized_index_list)
+        recognized_seconds += prefix_seconds * len(recognized_index_list)
+        cached_seconds += prefix_seconds * (len(prefix_index_list) - len(recognized_index_list))
+        for index, a_transcript in zip(prefix_index_list, prefix_transcript_list):
+            if _has_enough_words(a_transcript, word_threshold):
+                is_kept_list[index] = True
+                skipped_seconds += segment_seconds[index] - prefix_seconds
+
+        full_index_list = [index for index, is_kept in enumerate(is_kept_list) if is_kept is None]
+        full_segments = [segments[index] for index in full_index_list]
+        recognized_index_list = []
+        full_transcript_list = _get_transcript_list(full_segments, audio_file, number_of_thread, number_of_process,
+                                                    worker_stats, cache, recognized_index_list)
+        for index, a_transcript in zip(full_index_list, full_transcript_list):
+            is_kept_list[index] = _has_enough_words(a_transcript, word_threshold)
+        full_recognized_seconds = sum(segment_seconds[full_index_list[i]] for i in recognized_index_list)
+        recognized_seconds += full_recognized_seconds
+        cached_seconds += sum(segment_seconds[index] for index in full_index_list) - full_recognized_seconds
+
+    logging.info("speech to text early exit: recognized {:.1f} s, read {:.1f} s from the cache, skipped {:.1f} s "
+                 "of {:.1f} s of audio".format(recognized_seconds, cached_seconds, skipped_seconds,
+                                               sum(segment_seconds)))
+    if early_exit_stats is not None:
+        early_exit_stats.update({"audio_seconds": sum(segment_seconds), "recognized_seconds": recognized_seconds,
+                                 "cached_seconds": cached_seconds, "skipped_seconds": skipped_seconds})
+    return [line for line, is_kept in zip(segments, is_kept_list) if is_kept]
+
+
+def _is_empty_segment(line):
+    return int(float(line[1]) * 1000) - int(float(line[0]) * 1000) < 0.5
+
+
 def _clipping_audio(audio_path: str, audio_format: str, output_path: str, segments: list):
     """
     creating clips of audio to check if the alignment is correct.
@@ -241,16 +521,14 @@ def _clipping_audio(audio_path: str, audio_format: str, output_path: str, segmen
         clip.export(os.path.join(output_path, "{}_{}.wav".format(start, end)), "wav")
 
 
-def _speech2text_CMU(an_audio_path: str):
+def _speech2text_CMU_clip(clip: pydub.AudioSegment):
+    """
+    transcription of a clip in memory with CMU Sphinx, the recognizer takes the PCM data of the clip as it is
+    """
     r = sr.Recognizer()
-    with sr.AudioFile(an_audio_path) as source:
-        audio = r.record(source)  # read the entire audio file
-    # now it needs to use a temporary wav files to do the recognition. If necessary, it would be rewrite to use binary files using wave library
+    audio = sr.AudioData(clip.raw_data, clip.frame_rate, clip.sample_width)
 
     try:
-        recognition_result = r.recognize_sphinx(audio)
-        # print("Sphinx thinks you said:   " + recognition_result)
-        return recognition_result
+        return r.recognize_sphinx(audio)
     except sr.UnknownValueError:
         return ""
-